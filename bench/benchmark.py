@@ -0,0 +1,268 @@
+"""
+Benchmark for the REST API.
+
+Seeds a database with a configurable volume of rows, drives every endpoint through the
+WSGI app with concurrent clients and reports p50/p95/p99 latency, throughput and SQL
+queries per request (read from the Server-Timing header). Results can be saved as JSON
+and compared to flag regressions:
+
+    $ pipenv run bench --users 2000 --planets 5000 --output before.json
+    $ pipenv run bench --users 2000 --planets 5000 --output after.json
+    $ pipenv run bench-compare before.json after.json --threshold 10
+
+The write scenarios run after the reads and delete what they create, so the tables
+end as seeded. By default it uses a throwaway SQLite file; pass --db with a MySQL
+connection string to benchmark against MySQL (the database must be empty, tables are
+created if missing).
+The response cache is disabled unless --cache is given, so handlers are really measured.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+QUERIES = re.compile(r'db;dur=[0-9.]+;desc="(\d+) queries"')
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the REST API endpoints")
+    subparsers = parser.add_subparsers(dest="command")
+    run = subparsers.add_parser("run", help="seed a database and benchmark every endpoint")
+    run.add_argument("--db", help="connection string (default: a temporary SQLite file)")
+    run.add_argument("--users", type=int, default=500)
+    run.add_argument("--characters", type=int, default=1000)
+    run.add_argument("--planets", type=int, default=1000)
+    run.add_argument("--vehicles", type=int, default=1000)
+    run.add_argument("--favorites-per-user", type=int, default=10)
+    run.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    run.add_argument("--bulk-size", type=int, default=50, help="rows per bulk create/delete request")
+    run.add_argument("--concurrency", type=int, default=8)
+    run.add_argument("--seed", type=int, default=42)
+    run.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    run.add_argument("--output", help="save the results as JSON")
+    compare = subparsers.add_parser("compare", help="compare two saved runs")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.add_argument("--threshold", type=float, default=10.0, help="allowed p95 slowdown in percent")
+    if argv and argv[0] not in ("run", "compare", "-h", "--help"):
+        argv = ["run"] + argv
+    return parser.parse_args(argv or ["run"])
+
+def load_app(options):
+    database_uri = options.db or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DB_CONNECTION_STRING"] = database_uri
+    if not options.cache:
+        os.environ["CACHE_TTL"] = "0"
+    sys.path.insert(0, SRC)
+    from main import app
+    return app
+
+def seed(app, options):
+    """Fills the tables and returns (seconds, favorites inserted)."""
+    from models import db, User, Character, Planet, Vehicle, Favorite
+    from popularity import rebuild_counts
+    rng = random.Random(options.seed)
+    started = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        def insert(model, rows):
+            for start in range(0, len(rows), 5000):
+                db.session.bulk_insert_mappings(model, rows[start:start + 5000])
+            db.session.commit()
+        insert(User, [{"name": "user %d" % i, "username": "user%d" % i, "email": "user%d@example.com" % i,
+                       "password": "secret"} for i in range(options.users)])
+        insert(Character, [{"name": "character %d" % i, "age": rng.randint(1, 900), "gender": rng.choice(["female", "male", "n/a"]),
+                            "skin_color": rng.choice(["fair", "green", "metal"])} for i in range(options.characters)])
+        insert(Planet, [{"name": "planet %d" % i, "gravity": rng.randint(1, 3), "population": rng.randint(0, 10 ** 9),
+                         "climate": rng.choice(["arid", "temperate", "frozen", "murky"]),
+                         "terrain": rng.choice(["desert", "forest", "ice", "swamp"])} for i in range(options.planets)])
+        insert(Vehicle, [{"name": "vehicle %d" % i, "model": "model %d" % (i % 50), "capacity": rng.randint(1, 500),
+                          "vehicle_class": rng.choice(["wheeled", "repulsorcraft", "starfighter"])} for i in range(options.vehicles)])
+        favorites = []
+        for user_id in range(1, options.users + 1):
+            kinds = {"character_id": options.characters, "planet_id": options.planets, "vehicle_id": options.vehicles}
+            picked = set()
+            for _ in range(options.favorites_per_user):
+                kind = rng.choice(list(kinds))
+                picked.add((kind, rng.randint(1, kinds[kind])))
+            favorites.extend({"user_id": user_id, kind: item_id} for kind, item_id in picked)
+        insert(Favorite, favorites)
+        # bulk_insert_mappings no pasa por los contadores: se recalculan para el leaderboard
+        rebuild_counts()
+    return time.perf_counter() - started, len(favorites)
+
+def pairs(first_user, users, first_item, items):
+    """Distinct (user id, item id) pairs, in the same order on every call."""
+    for index in itertools.count():
+        yield first_user + index % users, first_item + index // users % items
+
+def scenarios(options, favorites):
+    """
+    (name, method, request factory) for every endpoint; factories take a seeded Random
+    and return the url, or (url, JSON body). The reads run first, then the writes, and
+    every delete removes rows created by an earlier scenario: the new users, the items
+    created one by one and in bulk, and the bulk favorites, whose ids follow the
+    `favorites` seeded ones.
+    """
+    users, requests, size = options.users, options.requests, options.bulk_size
+    totals = {"character": options.characters, "planet": options.planets, "vehicle": options.vehicles}
+    bodies = {
+        "character": lambda index: {"name": "bench character %d" % index, "age": 30, "gender": "n/a", "skin_color": "grey"},
+        "planet": lambda index: {"name": "bench planet %d" % index, "gravity": 1, "population": 1000,
+                                 "climate": "arid", "terrain": "desert"},
+        "vehicle": lambda index: {"name": "bench vehicle %d" % index, "model": "bench", "capacity": 4,
+                                  "vehicle_class": "wheeled"},
+    }
+
+    def create_user():
+        counter = itertools.count(1)
+        def factory(rng):
+            index = next(counter)
+            return "/user", {"name": "bench user %d" % index, "username": "bench%d" % index,
+                             "email": "bench%d@example.com" % index}
+        return factory
+
+    def create(kind):
+        counter = itertools.count(1)
+        return lambda rng: ("/" + kind, bodies[kind](next(counter)))
+
+    def create_bulk(kind):
+        counter = itertools.count(requests + 1)
+        return lambda rng: ("/" + kind + "/bulk", [bodies[kind](next(counter)) for _ in range(size)])
+
+    def create_favorites():
+        # los usuarios sembrados marcan los personajes creados por /character/bulk
+        pending = pairs(1, users, totals["character"] + requests + 1, requests * size)
+        return lambda rng: ("/favorite/bulk", [{"user_id": user_id, "character_id": item_id}
+                                               for user_id, item_id in itertools.islice(pending, size)])
+
+    def favorite(kind):
+        # los usuarios nuevos no tienen favoritos: cada par se crea y luego se borra una vez
+        pending = pairs(users + 1, requests, 1, totals[kind])
+        return lambda rng: "/user/%d/favorite/%s/%d" % (lambda user_id, item_id: (user_id, kind, item_id))(*next(pending))
+
+    def delete_one(kind, first):
+        counter = itertools.count(first)
+        return lambda rng: "/%s/%d" % (kind, next(counter))
+
+    def delete_bulk(kind, first):
+        counter = itertools.count(first, size)
+        return lambda rng: (lambda start: ("/" + kind + "/bulk", {"ids": list(range(start, start + size))}))(next(counter))
+
+    kinds = list(totals)
+    return [
+        ("GET /", "GET", lambda rng: "/"),
+        ("GET /routes", "GET", lambda rng: "/routes"),
+        ("GET /user", "GET", lambda rng: "/user"),
+        ("GET /user?include=favorites", "GET", lambda rng: "/user?include=favorites"),
+        ("GET /user/<id>", "GET", lambda rng: "/user/%d" % rng.randint(1, users)),
+        ("GET /user/<id>/favorites", "GET", lambda rng: "/user/%d/favorites" % rng.randint(1, users)),
+        ("GET /user/<id>/dashboard", "GET", lambda rng: "/user/%d/dashboard" % rng.randint(1, users)),
+        ("GET /character", "GET", lambda rng: "/character"),
+        ("GET /character/<id>", "GET", lambda rng: "/character/%d" % rng.randint(1, totals["character"])),
+        ("GET /character?ids=", "GET",
+         lambda rng: "/character?ids=" + ",".join(str(rng.randint(1, totals["character"])) for _ in range(20))),
+        ("GET /planet", "GET", lambda rng: "/planet"),
+        ("GET /planet?climate=arid", "GET", lambda rng: "/planet?climate=arid&population_gt=1000000"),
+        ("GET /planet/<id>", "GET", lambda rng: "/planet/%d" % rng.randint(1, totals["planet"])),
+        ("GET /vehicle", "GET", lambda rng: "/vehicle"),
+        ("GET /vehicle/<id>", "GET", lambda rng: "/vehicle/%d" % rng.randint(1, totals["vehicle"])),
+        ("GET /favorite", "GET", lambda rng: "/favorite"),
+        ("GET /search?q=", "GET", lambda rng: "/search?q=%s+%d" % (rng.choice(kinds), rng.randint(1, 99))),
+        ("GET /search?mode=fuzzy", "GET", lambda rng: "/search?mode=fuzzy&q=plnet+%d" % rng.randint(1, 99)),
+        ("GET /leaderboard/<kind>", "GET", lambda rng: "/leaderboard/" + rng.choice(kinds)),
+        ("GET /health/db", "GET", lambda rng: "/health/db"),
+        ("GET /metrics", "GET", lambda rng: "/metrics"),
+        ("GET /cache/stats", "GET", lambda rng: "/cache/stats"),
+        ("POST /user", "POST", create_user()),
+    ] + [("POST /" + kind, "POST", create(kind)) for kind in kinds] + [
+        ("POST /%s/bulk" % kind, "POST", create_bulk(kind)) for kind in kinds] + [
+        ("POST /favorite/bulk", "POST", create_favorites()),
+        ("DELETE /favorite/bulk", "DELETE", delete_bulk("favorite", favorites + 1)),
+    ] + [("POST /user/<id>/favorite/%s/<id>" % kind, "POST", favorite(kind)) for kind in kinds] + [
+        ("DELETE /user/<id>/favorite/%s/<id>" % kind, "DELETE", favorite(kind)) for kind in kinds] + [
+        ("DELETE /%s/<id>" % kind, "DELETE", delete_one(kind, totals[kind] + 1)) for kind in kinds] + [
+        ("DELETE /%s/bulk" % kind, "DELETE", delete_bulk(kind, totals[kind] + requests + 1)) for kind in kinds] + [
+        ("DELETE /user/<id>", "DELETE", delete_one("user", users + 1)),
+    ]
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def run_scenario(app, method, requests, concurrency):
+    def call(request):
+        url, body = request if isinstance(request, tuple) else (request, None)
+        client = app.test_client()
+        started = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        elapsed = time.perf_counter() - started
+        match = QUERIES.search(response.headers.get("Server-Timing", ""))
+        return elapsed, response.status_code, int(match.group(1)) if match else 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, requests))
+    wall = time.perf_counter() - started
+    latencies = [elapsed * 1000 for elapsed, status, queries in results]
+    return {
+        "requests": len(results),
+        "errors": sum(1 for elapsed, status, queries in results if status >= 400),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "throughput_rps": round(len(results) / wall, 1),
+        "queries_per_request": round(sum(queries for elapsed, status, queries in results) / len(results), 2),
+    }
+
+def print_table(results):
+    print("%-40s %9s %9s %9s %10s %8s %7s" % ("endpoint", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries", "errors"))
+    for name, result in results.items():
+        print("%-40s %9.2f %9.2f %9.2f %10.1f %8.2f %7d" % (name, result["p50_ms"], result["p95_ms"], result["p99_ms"],
+                                                         result["throughput_rps"], result["queries_per_request"], result["errors"]))
+
+def run(options):
+    app = load_app(options)
+    seconds, favorites = seed(app, options)
+    print("seeded in %.1fs" % seconds)
+    rng = random.Random(options.seed)
+    results = {}
+    for name, method, factory in scenarios(options, favorites):
+        requests = [factory(rng) for _ in range(options.requests)]
+        results[name] = run_scenario(app, method, requests, options.concurrency)
+    print_table(results)
+    if options.output:
+        settings = {key: value for key, value in vars(options).items() if key not in ("command", "output", "db")}
+        with open(options.output, "w") as output:
+            json.dump({"settings": settings, "results": results}, output, indent=2)
+    return 0
+
+def compare(options):
+    with open(options.before) as before_file, open(options.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    if before["settings"] != after["settings"]:
+        print("warning: the runs used different settings, the comparison may not be meaningful")
+    regressions = 0
+    print("%-40s %10s %10s %8s %12s" % ("endpoint", "p95 before", "p95 after", "change", "queries"))
+    for name, old in before["results"].items():
+        new = after["results"].get(name)
+        if new is None:
+            continue
+        change = (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+        flag = ""
+        if change > options.threshold or new["queries_per_request"] > old["queries_per_request"]:
+            flag, regressions = "  REGRESSION", regressions + 1
+        print("%-40s %10.2f %10.2f %+7.1f%% %5.2f->%5.2f%s" % (name, old["p95_ms"], new["p95_ms"], change,
+                                                             old["queries_per_request"], new["queries_per_request"], flag))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    sys.exit(compare(arguments) if arguments.command == "compare" else run(arguments))
@@ -0,0 +1,83 @@
+"""
+Micro benchmark of the list serialization path: ORM objects vs row tuples and the
+stdlib json module vs orjson, over N planets in a temporary SQLite database.
+
+    $ pipenv run python bench/serialization.py --rows 50000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args(argv)
+
+    os.environ["DB_CONNECTION_STRING"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "serialization.db")
+    sys.path.insert(0, SRC)
+    from main import app
+    from models import db, Planet
+    from serialization import FastJSONEncoder, public_columns, orjson
+
+    def hand_written(planet):
+        # el serialize() escrito a mano que tenia el modelo antes
+        return {"id": planet.id, "name": planet.name, "gravity": planet.gravity, "population": planet.population,
+                "climate": planet.climate, "terrain": planet.terrain}
+
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(Planet, [{"name": "planet %d" % i, "gravity": 1, "population": i,
+                                                  "climate": "arid", "terrain": "desert"} for i in range(options.rows)])
+        db.session.commit()
+        names = list(public_columns(Planet))
+        columns = [getattr(Planet, name) for name in names]
+
+        def orm_objects(serialize):
+            db.session.expunge_all()
+            return [serialize(planet) for planet in Planet.query.order_by(Planet.id)]
+
+        def row_tuples():
+            return [dict(zip(names, row)) for row in db.session.query(*columns).order_by(Planet.id)]
+
+        builds = [
+            ("ORM + hand written serialize", lambda: orm_objects(hand_written)),
+            ("ORM + column serializer", lambda: orm_objects(Planet.serialize)),
+            ("row tuples", row_tuples),
+        ]
+        encoders = [("json", lambda data: json.dumps(data, sort_keys=True))]
+        if orjson is not None:
+            encoders.append(("orjson", lambda data: FastJSONEncoder(sort_keys=True).encode(data)))
+        else:
+            print("orjson is not installed, skipping the orjson encoder")
+
+        print("%-40s %10s %8s" % ("rows -> dicts (%d rows)" % options.rows, "best ms", "speedup"))
+        baseline, rows = None, None
+        for name, build in builds:
+            seconds = best_of(options.repeat, build)
+            baseline = baseline or seconds
+            print("%-40s %10.1f %7.2fx" % (name, seconds * 1000, baseline / seconds))
+            rows = build()
+
+        print("%-40s %10s %8s" % ("dicts -> JSON", "best ms", "speedup"))
+        baseline = None
+        for name, encode in encoders:
+            seconds = best_of(options.repeat, lambda: encode({"response": rows}))
+            baseline = baseline or seconds
+            print("%-40s %10.1f %7.2fx" % (name, seconds * 1000, baseline / seconds))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
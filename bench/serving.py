@@ -0,0 +1,102 @@
+"""
+Side by side throughput of gunicorn sync workers (what the Procfile runs) and gthread
+workers, the opt-in threaded mode: GUNICORN_CMD_ARGS="--threads N" makes gunicorn
+switch to gthread with N threads per worker. Both get the same seeded database and
+the same number of processes, and are driven over real HTTP with many concurrent
+clients.
+
+    $ pipenv run python bench/serving.py --workers 2 --threads 4 --concurrency 64 --requests 2000
+    $ pipenv run python bench/serving.py --db mysql+mysqlconnector://root@localhost/bench
+
+The gap grows with database latency: against a remote MySQL each sync worker sits
+idle while it waits for the database, while the other threads of a gthread worker
+keep serving requests.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+sys.path.insert(0, BENCH)
+from benchmark import load_app, seed, percentile
+
+PATHS = ["/planet?limit=100", "/user?include=favorites&limit=50", "/character/1", "/health/db"]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_ready(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited with code " + str(process.returncode))
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("the server did not start in " + str(timeout) + "s")
+
+def drive(base_url, path, requests, concurrency):
+    def call(_):
+        started = time.perf_counter()
+        with urllib.request.urlopen(base_url + path, timeout=60) as response:
+            response.read()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, range(requests)))
+    wall = time.perf_counter() - started
+    return requests / wall, percentile([latency * 1000 for latency in latencies], 95)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Compare gunicorn sync and gthread workers")
+    parser.add_argument("--db", help="connection string (default: a temporary SQLite file)")
+    parser.add_argument("--workers", type=int, default=2, help="processes for each server")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gthread worker")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    parser.add_argument("--seed", type=int, default=42)
+    options = parser.parse_args(argv)
+
+    seed_options = argparse.Namespace(db=options.db, cache=False, seed=options.seed, users=500, characters=1000,
+                                      planets=1000, vehicles=1000, favorites_per_user=10)
+    seed(load_app(seed_options), seed_options)
+    environment = dict(os.environ, DB_POOL_SIZE=str(options.threads), DB_MAX_OVERFLOW="0")
+
+    gunicorn = [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", SRC,
+                "--workers", str(options.workers), "--bind", "127.0.0.1:{port}"]
+    servers = {
+        "gunicorn sync": gunicorn,
+        "gunicorn gthread x" + str(options.threads): gunicorn + ["--worker-class", "gthread", "--threads", str(options.threads)],
+    }
+    results = {}
+    for name, command in servers.items():
+        port = free_port()
+        process = subprocess.Popen([part.replace("{port}", str(port)) for part in command], env=environment,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base_url = "http://127.0.0.1:" + str(port)
+            wait_until_ready(base_url + "/health/db", process)
+            results[name] = {path: drive(base_url, path, options.requests, options.concurrency) for path in PATHS}
+        finally:
+            process.terminate()
+            process.wait()
+
+    print("%-36s %-24s %10s %10s" % ("endpoint", "server", "req/s", "p95 ms"))
+    for path in PATHS:
+        for name in servers:
+            throughput, p95 = results[name][path]
+            print("%-36s %-24s %10.1f %10.1f" % (path, name, throughput, p95))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
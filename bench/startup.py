@@ -0,0 +1,78 @@
+"""
+Cold start time of the app, what every gunicorn worker pays on boot and respawn:
+each sample is a fresh interpreter importing src/main.py (which builds the app).
+Also shows what the first /admin request costs now that the admin is built lazily,
+and the slowest imports reported by `python -X importtime`.
+
+    $ pipenv run python bench/startup.py --repeat 10 --imports 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+SNIPPET = """
+import time
+started = time.perf_counter()
+import main
+booted = time.perf_counter()
+if %(admin)r:
+    main.app.test_client().get('/admin/')
+print(booted - started, time.perf_counter() - booted)
+"""
+
+VARIANTS = [
+    ("default (lazy admin, CORS)", {}, False),
+    ("default + first /admin request", {}, True),
+    ("API only (no admin, no CORS)", {"FEATURE_ADMIN": "false", "FEATURE_CORS": "false"}, False),
+    ("with swagger", {"FEATURE_SWAGGER": "true"}, False),
+]
+
+def sample(environment, admin):
+    output = subprocess.run([sys.executable, "-c", SNIPPET % {"admin": admin}], cwd=SRC, env=environment,
+                            check=True, capture_output=True, text=True).stdout
+    boot, first_admin = output.split()
+    return float(boot), float(first_admin)
+
+def slowest_imports(environment, count):
+    """(cumulative ms, module) of the top level imports of main, from -X importtime."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=SRC, env=environment,
+                            check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        # dos espacios de sangria por nivel: main y lo que main importa directamente
+        depth = (len(module) - 1 - len(module.lstrip())) // 2
+        if cumulative.strip().isdigit() and depth <= 1:
+            imports.append((int(cumulative) / 1000, module.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measure the cold start of the API")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--imports", type=int, default=15, help="how many of the slowest imports to list")
+    options = parser.parse_args(argv)
+
+    base = dict(os.environ, DB_CONNECTION_STRING="sqlite:///" + os.path.join(tempfile.mkdtemp(), "startup.db"))
+    base.pop("FLASK_RUN_FROM_CLI", None)
+    print("%-36s %12s %12s %18s" % ("variant", "median ms", "min ms", "first /admin ms"))
+    for name, overrides, admin in VARIANTS:
+        samples = [sample(dict(base, **overrides), admin) for _ in range(options.repeat)]
+        boots = [boot * 1000 for boot, first_admin in samples]
+        first_admin = statistics.median(first_admin * 1000 for boot, first_admin in samples) if admin else None
+        print("%-36s %12.1f %12.1f %18s" % (name, statistics.median(boots), min(boots),
+                                            "%.1f" % first_admin if admin else "-"))
+
+    print()
+    print("%-36s %12s" % ("slowest top level imports", "ms"))
+    for milliseconds, module in slowest_imports(base, options.imports):
+        print("%-36s %12.1f" % (module, milliseconds))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -27,6 +27,13 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# the FULLTEXT indexes used by /search only exist on MySQL and are created by hand
+# in their migration, so autogenerate must not try to drop them
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == "index" and reflected and compare_to is None and name.endswith("_fulltext"):
+        return False
+    return True
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -83,6 +90,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
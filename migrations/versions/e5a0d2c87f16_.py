@@ -0,0 +1,33 @@
+"""full-text indexes on entity names for /search
+
+Revision ID: e5a0d2c87f16
+Revises: c41e9a7d25b3
+Create Date: 2026-10-18 15:12:48.207531
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a0d2c87f16'
+down_revision = 'c41e9a7d25b3'
+branch_labels = None
+depends_on = None
+
+TABLES = ('character', 'planet', 'vehicle')
+
+
+def upgrade():
+    # only MySQL has FULLTEXT; on the other databases search.py uses its in-process index
+    if op.get_bind().dialect.name != 'mysql':
+        return
+    for table in TABLES:
+        op.create_index('ix_' + table + '_name_fulltext', table, ['name'], unique=False, mysql_prefix='FULLTEXT')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'mysql':
+        return
+    for table in TABLES:
+        op.drop_index('ix_' + table + '_name_fulltext', table_name=table)
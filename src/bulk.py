@@ -0,0 +1,213 @@
+"""
+Bulk create and delete for the entity tables. Rows are validated against the model
+columns, inserted with `bulk_insert_mappings` in chunks inside a single transaction
+and every rejected row is reported back with its index.
+"""
+import json
+import os
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+from models import db, Favorite
+from utils import APIException
+from cache import mark_changed
+from popularity import adjust_counts, discount_favorites
+from snapshot import mark_deleted
+from search import unindex
+
+DEFAULT_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+MAX_CHUNK_SIZE = 10000
+MAX_DELETE_IDS = 10000
+
+def writable_columns(model):
+    counters = getattr(model, "counter_fields", ())
+    return {column.name: column for column in model.__table__.columns
+            if not column.primary_key and column.name not in counters}
+
+def validate_row(model, row):
+    """Returns the error message for `row`, or None if it can be inserted."""
+    if not isinstance(row, dict):
+        return "Row must be a JSON object"
+    columns = writable_columns(model)
+    unknown = [key for key in row if key not in columns]
+    if unknown:
+        return "Unknown fields: " + ", ".join(unknown)
+    for name, column in columns.items():
+        value = row.get(name)
+        if value is None:
+            if not column.nullable:
+                return "Missing field: " + name
+            continue
+        python_type = column.type.python_type
+        if python_type is int and (not isinstance(value, int) or isinstance(value, bool)):
+            return "'" + name + "' must be an integer"
+        if python_type is str:
+            if not isinstance(value, str):
+                return "'" + name + "' must be a string"
+            if column.type.length is not None and len(value) > column.type.length:
+                return "'" + name + "' is longer than " + str(column.type.length) + " characters"
+    return None
+
+def missing_references(model, rows):
+    """
+    Checks the foreign keys of a chunk with one IN query per referenced table and
+    returns {row_index: message} for the rows pointing to ids that do not exist.
+    """
+    errors = {}
+    for name, column in writable_columns(model).items():
+        for foreign_key in column.foreign_keys:
+            target = foreign_key.column
+            ids = set(row[name] for index, row in rows if row.get(name) is not None)
+            if not ids:
+                continue
+            found = set(value for (value,) in db.session.query(target).filter(target.in_(ids)))
+            for index, row in rows:
+                if row.get(name) is not None and row[name] not in found:
+                    errors.setdefault(index, "'" + name + "' " + str(row[name]) + " does not exist")
+    return errors
+
+def unique_keys(model):
+    """Column tuples of the unique indexes/constraints, besides the primary key."""
+    keys = [tuple(column.name for column in index.columns) for index in model.__table__.indexes if index.unique]
+    for constraint in model.__table__.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            keys.append(tuple(column.name for column in constraint.columns))
+    keys.extend((column.name,) for column in model.__table__.columns if column.unique)
+    return keys
+
+def duplicate_rows(model, rows, seen):
+    """
+    Returns the indexes of the rows that repeat a unique key already in the table or
+    earlier in the batch (`seen` carries the keys across chunks). Rows with a NULL in
+    the key never collide, like in the database.
+    """
+    duplicates = set()
+    for key in unique_keys(model):
+        candidates = [(index, tuple(row.get(name) for name in key)) for index, row in rows]
+        candidates = [(index, values) for index, values in candidates if None not in values]
+        if not candidates:
+            continue
+        # un IN por columna trae un superconjunto, que se filtra en python
+        query = db.session.query(*[getattr(model, name) for name in key])
+        for position, name in enumerate(key):
+            query = query.filter(getattr(model, name).in_(set(values[position] for index, values in candidates)))
+        existing = set(tuple(row) for row in query)
+        batch = seen.setdefault(key, set())
+        for index, values in candidates:
+            if values in existing or values in batch:
+                duplicates.add(index)
+            batch.add(values)
+    return duplicates
+
+def read_rows(request):
+    """Yields the rows of a JSON array body or, line by line, of an NDJSON body."""
+    if request.mimetype == "application/x-ndjson":
+        for line in request.stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+        return
+    body = request.get_json(silent=True)
+    if not isinstance(body, list):
+        raise APIException("You need to send a JSON array or an application/x-ndjson body", status_code=400)
+    for row in body:
+        yield row
+
+def parse_chunk_size(args):
+    try:
+        chunk_size = int(args.get("chunk_size", DEFAULT_CHUNK_SIZE))
+    except ValueError:
+        raise APIException("'chunk_size' must be an integer", status_code=400)
+    if chunk_size < 1 or chunk_size > MAX_CHUNK_SIZE:
+        raise APIException("'chunk_size' must be between 1 and " + str(MAX_CHUNK_SIZE), status_code=400)
+    return chunk_size
+
+def insert_chunk(model, chunk, errors, seen):
+    """Inserts the chunk and returns (created, skipped); duplicates are skipped, not errors."""
+    rejected = missing_references(model, chunk)
+    for index, message in rejected.items():
+        errors.append({"index": index, "message": message})
+    chunk = [(index, row) for index, row in chunk if index not in rejected]
+    duplicates = duplicate_rows(model, chunk, seen)
+    mappings = [row for index, row in chunk if index not in duplicates]
+    if mappings:
+        db.session.bulk_insert_mappings(model, mappings)
+        if model is Favorite:
+            adjust_counts(mappings, 1)
+    return len(mappings), len(duplicates)
+
+def bulk_create(model, request):
+    """
+    Inserts every valid row of the request body and returns
+    {"created": n, "skipped": n, "errors": [{"index": i, "message": ...}]}, where skipped
+    rows already existed. All the chunks share one transaction, so a database error
+    rolls back the whole batch.
+    """
+    chunk_size = parse_chunk_size(request.args)
+    created, skipped, errors, chunk, seen = 0, 0, [], [], {}
+    try:
+        for index, row in enumerate(read_rows(request)):
+            message = "Invalid JSON" if row is None else validate_row(model, row)
+            if message is not None:
+                errors.append({"index": index, "message": message})
+                continue
+            chunk.append((index, row))
+            if len(chunk) == chunk_size:
+                chunk_created, chunk_skipped = insert_chunk(model, chunk, errors, seen)
+                created, skipped, chunk = created + chunk_created, skipped + chunk_skipped, []
+        if chunk:
+            chunk_created, chunk_skipped = insert_chunk(model, chunk, errors, seen)
+            created, skipped = created + chunk_created, skipped + chunk_skipped
+        mark_changed(db.session, model.__table__.name)
+        db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        raise APIException("Nothing was created: " + str(error.orig), status_code=409)
+    errors.sort(key=lambda error: error["index"])
+    return {"created": created, "skipped": skipped, "errors": errors}
+
+def delete_rows(model, ids):
+    """
+    Deletes the `ids` rows of `model` and the favorites pointing to them, with one
+    set-based DELETE ... WHERE each and without loading any row into the session.
+    The popularity counters of the items that stay are lowered in the database.
+    Returns how many `model` rows were deleted; the caller commits.
+    """
+    if model is Favorite:
+        discount_favorites(Favorite.id.in_(ids))
+    for column in Favorite.__table__.columns:
+        if any(foreign_key.column.table is model.__table__ for foreign_key in column.foreign_keys):
+            condition = getattr(Favorite, column.name).in_(ids)
+            discount_favorites(condition, skip=model)
+            Favorite.query.filter(condition).delete(synchronize_session=False)
+    mark_deleted(db.session, model, ids)
+    unindex(db.session, model, ids)
+    return model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+
+def delete_one(model, object_id):
+    try:
+        deleted = delete_rows(model, [object_id])
+        if not deleted:
+            db.session.rollback()
+            raise APIException(model.__name__ + " not found", status_code=404)
+        db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        raise APIException("Nothing was deleted: " + str(error.orig), status_code=409)
+    return {"deleted": True}
+
+def bulk_delete(model, request):
+    body = request.get_json(silent=True)
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(value, int) and not isinstance(value, bool) for value in ids):
+        raise APIException("You need to send {\"ids\": [...]} with integer ids", status_code=400)
+    if len(ids) > MAX_DELETE_IDS:
+        raise APIException("You can delete at most " + str(MAX_DELETE_IDS) + " ids at once", status_code=400)
+    try:
+        deleted = delete_rows(model, ids) if ids else 0
+        db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        raise APIException("Nothing was deleted: " + str(error.orig), status_code=409)
+    return {"deleted": deleted}
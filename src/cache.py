@@ -0,0 +1,261 @@
+"""
+Read-through response cache and conditional GET (ETag / Last-Modified) support
+for the GET endpoints.
+
+Every table has a version counter that is bumped after each commit touching it;
+cache keys embed the versions of the tables a route reads, so a write invalidates
+all the cached responses built from that table without scanning for keys.
+Two backends are available, picked with CACHE_BACKEND:
+- memory: an in-process LRU bounded by CACHE_MAX_ENTRIES (one per gunicorn worker,
+  so other workers may serve stale data for up to CACHE_TTL seconds)
+- redis: shared by all the workers, needs the `redis` package and REDIS_URL
+ETags are derived from the same versions, so a matching If-None-Match is answered
+with a 304 before the handler runs: no database query and no serialization.
+With the memory backend the versions only see the commits of the worker itself, so
+its ETags also change every CACHE_TTL seconds (the same staleness as its cached
+bodies), and with CACHE_TTL=0 no validators are sent at all.
+"""
+import calendar
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Response, current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db
+from collection import wants_ndjson
+from replicas import read_after_write
+
+class LRUCache:
+    # los contadores son de este proceso: los ETags llevan un id propio del worker
+    # para que nunca coincidan con los de otro, y no se envia Last-Modified
+    shared = False
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.modified = {}
+        self.lock = threading.Lock()
+        self.epoch = os.urandom(8).hex()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def get_counters(self, keys):
+        with self.lock:
+            return [self.counters.get(key, 0) for key in keys]
+
+    def set_modified(self, key, timestamp):
+        with self.lock:
+            self.modified[key] = timestamp
+
+    def get_modified(self, keys):
+        with self.lock:
+            return [self.modified.get(key) for key in keys]
+
+    def size(self):
+        return len(self.entries)
+
+class RedisCache:
+    """
+    Works with any client exposing the redis-py `get`, `set(ex=)`, `incr`, `mget`
+    and `dbsize` methods, so the tests run it on a dict-backed fake (tests/fakes.py).
+    """
+    shared = True
+    epoch = ""
+
+    def __init__(self, client, ttl=60, prefix="swapi:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + "version:" + key)
+
+    def get_counters(self, keys):
+        values = self.client.mget([self.prefix + "version:" + key for key in keys])
+        return [int(value or 0) for value in values]
+
+    def set_modified(self, key, timestamp):
+        self.client.set(self.prefix + "modified:" + key, timestamp)
+
+    def get_modified(self, keys):
+        values = self.client.mget([self.prefix + "modified:" + key for key in keys])
+        return [float(value) if value is not None else None for value in values]
+
+    def size(self):
+        return self.client.dbsize()
+
+backend = LRUCache()
+stats = {"hits": 0, "misses": 0}
+stats_lock = threading.Lock()
+
+def setup_cache(app):
+    global backend
+    ttl = int(os.environ.get('CACHE_TTL', 60))
+    if os.environ.get('CACHE_BACKEND', 'memory') == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package: pipenv install redis")
+        backend = RedisCache(redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0')), ttl=ttl)
+    else:
+        backend = LRUCache(max_entries=int(os.environ.get('CACHE_MAX_ENTRIES', 1024)), ttl=ttl)
+
+def count(name):
+    with stats_lock:
+        stats[name] += 1
+
+def get_stats():
+    with stats_lock:
+        result = dict(stats)
+    result["entries"] = backend.size()
+    return result
+
+def table_versions(tables):
+    return dict(zip(tables, backend.get_counters(tables)))
+
+def bump_versions(tables):
+    now = time.time()
+    for table in tables:
+        backend.incr(table)
+        backend.set_modified(table, now)
+
+def last_write(tables):
+    """Latest write time of `tables` seen by the backend, or None if unknown."""
+    timestamps = [timestamp for timestamp in backend.get_modified(tables) if timestamp is not None]
+    return max(timestamps) if timestamps else None
+
+# Versionado de tablas: cualquier commit (endpoints, admin, shell) invalida la cache
+
+def mark_changed(session, *tables):
+    """For writes that skip the unit of work (bulk inserts, query.delete())."""
+    session.info.setdefault("changed_tables", set()).update(tables)
+
+@event.listens_for(Session, "after_flush")
+def collect_changed_tables(session, flush_context):
+    objects = list(session.new) + list(session.dirty) + list(session.deleted)
+    mark_changed(session, *[obj.__table__.name for obj in objects])
+
+@event.listens_for(Session, "after_bulk_delete")
+@event.listens_for(Session, "after_bulk_update")
+def collect_bulk_changed_tables(update_context):
+    mark_changed(update_context.session, update_context.mapper.local_table.name)
+
+@event.listens_for(Session, "after_commit")
+def bump_changed_tables(session):
+    bump_versions(session.info.pop("changed_tables", ()))
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_tables(session):
+    session.info.pop("changed_tables", None)
+
+def cache_key(tables):
+    versions = table_versions(tables)
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return request.path + "?" + query + "|" + ",".join(table + ":" + str(versions[table]) for table in tables)
+
+def response_etag(key, ndjson):
+    """The ETag for the cache `key`, or None when the versions can't back one."""
+    seed = key + ("|ndjson" if ndjson else "")
+    if not backend.shared:
+        if backend.ttl <= 0:
+            return None
+        # las versiones de otros workers no se ven: el ETag caduca como el cuerpo cacheado
+        seed += "|" + str(int(time.monotonic() // backend.ttl))
+    return hashlib.sha1((backend.epoch + seed).encode()).hexdigest()
+
+def not_modified(etag, modified_at):
+    if request.if_none_match:
+        # comparacion debil: las respuestas comprimidas llevan el ETag como W/"..."
+        return request.if_none_match.contains_weak(etag)
+    if modified_at is not None and request.if_modified_since is not None:
+        return int(modified_at) <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
+
+def set_validators(response, etag, modified_at):
+    if etag is None:
+        return response
+    response.set_etag(etag)
+    if modified_at is not None:
+        response.last_modified = int(modified_at)
+    return response
+
+def skip_cache():
+    """Keeps the current response out of the cache and without validators."""
+    g.skip_cache = True
+
+def cached(*tables, extra_key=None):
+    """
+    Adds ETag/Last-Modified validators to a GET and caches the JSON body of successful
+    responses, keyed on path, query string and the versions of `tables`, plus what the
+    `extra_key` callable returns for data kept outside the tables.
+    Streamed responses get validators but their body is never cached; a view built
+    from data older than the versions calls skip_cache(). The view reads
+    from the primary while its tables are within the replica lag window.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = cache_key(tables) + ("|" + extra_key() if extra_key is not None else "")
+            ndjson = wants_ndjson(request)
+            etag = response_etag(key, ndjson)
+            written_at = last_write(tables)
+            # Last-Modified solo si todos los workers ven las mismas escrituras
+            modified_at = written_at if backend.shared else None
+            if etag is not None and not_modified(etag, modified_at):
+                return set_validators(Response(status=304), etag, modified_at)
+
+            use_cache = backend.ttl > 0 and not ndjson
+            body = backend.get(key) if use_cache else None
+            if body is not None:
+                count("hits")
+                response = Response(body, mimetype="application/json")
+                response.headers["X-Cache"] = "HIT"
+                return set_validators(response, etag, modified_at)
+            # una replica atrasada dejaria en cache las filas viejas con las versiones nuevas
+            read_after_write(db.session, written_at)
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or g.get("skip_cache"):
+                return response
+            if use_cache:
+                count("misses")
+                response.headers["X-Cache"] = "MISS"
+                if not response.is_streamed:
+                    backend.set(key, response.get_data())
+            return set_validators(response, etag, modified_at)
+        return wrapper
+    return decorator
@@ -0,0 +1,275 @@
+"""
+Shared query layer for the collection GET endpoints: keyset pagination on `id`,
+`?fields=` column projection, equality/range filters over indexed columns and
+`?include=` expansion of relationships loaded eagerly in a fixed number of queries,
+plus streamed (chunked JSON / NDJSON) variants for large collections and batch
+lookups by id list.
+"""
+from flask import Response, json, jsonify, stream_with_context
+from sqlalchemy.orm import Load
+from models import db
+from utils import APIException
+from metrics import timer
+from serialization import public_columns
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH = 1000
+MAX_BATCH_IDS = 100
+NDJSON_MIMETYPE = "application/x-ndjson"
+RESERVED_ARGS = ("limit", "cursor", "fields", "include", "stream")
+RANGE_OPERATORS = {
+    "gt": lambda column, value: column > value,
+    "gte": lambda column, value: column >= value,
+    "lt": lambda column, value: column < value,
+    "lte": lambda column, value: column <= value,
+}
+
+def filterable_columns(model):
+    # solo se filtra por columnas con indice (propio o primera columna de uno compuesto),
+    # para no hacer full table scans
+    leading = set(list(index.columns)[0].name for index in model.__table__.indexes)
+    return {name: column for name, column in public_columns(model).items()
+            if column.primary_key or column.index or column.unique or name in leading}
+
+def parse_int_arg(args, name, default=None):
+    value = args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise APIException("'" + name + "' must be an integer", status_code=400)
+
+def parse_fields(model, args):
+    if not args.get("fields"):
+        return None
+    columns = public_columns(model)
+    fields = [field.strip() for field in args.get("fields").split(",") if field.strip()]
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise APIException("Unknown fields: " + ", ".join(unknown), status_code=400)
+    # el id siempre se devuelve porque es el cursor de la siguiente pagina
+    if "id" not in fields:
+        fields.insert(0, "id")
+    return fields
+
+def coerce_value(column, name, value):
+    try:
+        return column.type.python_type(value)
+    except (TypeError, ValueError):
+        raise APIException("Invalid value for '" + name + "': " + value, status_code=400)
+
+def parse_filters(model, args):
+    columns = filterable_columns(model)
+    conditions = []
+    for key, value in args.items():
+        if key in RESERVED_ARGS:
+            continue
+        name, operator = key, None
+        if "_" in key and key.rsplit("_", 1)[1] in RANGE_OPERATORS:
+            name, operator = key.rsplit("_", 1)
+        if name not in columns:
+            raise APIException("Cannot filter by '" + key + "'", status_code=400)
+        column = getattr(model, name)
+        value = coerce_value(columns[name], key, value)
+        if operator is None:
+            conditions.append(column == value)
+        else:
+            conditions.append(RANGE_OPERATORS[operator](column, value))
+    return conditions
+
+def parse_include(model, args):
+    """
+    Turns `?include=favorites,favorites.character` into a nested dict like
+    {"favorites": {"character": {}}}, validating every step against `model.relations`.
+    """
+    tree = {}
+    if not args.get("include"):
+        return tree
+    for path in args.get("include").split(","):
+        current_model, node = model, tree
+        for name in [step.strip() for step in path.split(".")]:
+            relations = getattr(current_model, "relations", {})
+            if name not in relations:
+                raise APIException("Cannot include '" + path.strip() + "'", status_code=400)
+            node = node.setdefault(name, {})
+            current_model = getattr(current_model, relations[name]).property.mapper.class_
+    return tree
+
+def load_options(model, tree, strategy, parent=None):
+    """
+    Builds the eager loading options for an include tree. `strategy` is "selectinload"
+    for lists (one extra query per relationship, whatever the page size) and
+    "joinedload" for single rows (everything in the same query).
+    """
+    options = []
+    for name, children in tree.items():
+        attribute = getattr(model, model.relations[name])
+        option = getattr(parent if parent is not None else Load(model), strategy)(attribute)
+        options.append(option)
+        options.extend(load_options(attribute.property.mapper.class_, children, strategy, option))
+    return options
+
+def serialize_tree(obj, tree):
+    serialized = obj.serialize()
+    for name, children in tree.items():
+        related = getattr(obj, obj.relations[name])
+        if related is None:
+            serialized[name] = None
+        elif isinstance(related, list):
+            serialized[name] = list(map(lambda x: serialize_tree(x, children), related))
+        else:
+            serialized[name] = serialize_tree(related, children)
+    return serialized
+
+def get_one(model, object_id, args):
+    include = parse_include(model, args)
+    obj = model.query.options(*load_options(model, include, "joinedload")).filter_by(id=object_id).first()
+    if obj is None:
+        raise APIException(model.__name__ + " not found", status_code=404)
+    with timer("serialize"):
+        return serialize_tree(obj, include)
+
+def fetch_by_ids(model, ids, fields=None):
+    """Serialized rows of `model` for `ids` in a single IN query, as {id: row}."""
+    if not ids:
+        return {}
+    fields = fields or list(public_columns(model))
+    rows = db.session.query(*[getattr(model, field) for field in fields]).filter(model.id.in_(set(ids)))
+    with timer("serialize"):
+        return {row.id: dict(zip(fields, row)) for row in rows}
+
+def parse_ids(args):
+    ids, seen = [], set()
+    for value in args.get("ids").split(","):
+        try:
+            object_id = int(value)
+        except ValueError:
+            raise APIException("'ids' must be a comma separated list of integers", status_code=400)
+        if object_id not in seen:
+            ids.append(object_id)
+            seen.add(object_id)
+    if len(ids) > MAX_BATCH_IDS:
+        raise APIException("You can ask for at most " + str(MAX_BATCH_IDS) + " ids at once", status_code=400)
+    return ids
+
+def get_batch(model, args):
+    """
+    `?ids=3,1,2`: the rows in the requested order, fetched with one IN query, plus
+    the ids that do not exist under "missing". Only `fields` can be combined with it.
+    """
+    unsupported = [name for name in args if name not in ("ids", "fields")]
+    if unsupported:
+        raise APIException("'ids' cannot be combined with: " + ", ".join(unsupported), status_code=400)
+    ids = parse_ids(args)
+    rows = fetch_by_ids(model, ids, parse_fields(model, args))
+    return {"response": [rows[object_id] for object_id in ids if object_id in rows],
+            "missing": [object_id for object_id in ids if object_id not in rows]}
+
+def build_query(model, args, default_limit=DEFAULT_LIMIT):
+    """
+    Parses the collection arguments and returns (query, fields, include, limit).
+    Without `include` the query returns plain row tuples named after `fields`, skipping
+    ORM object hydration; with it, model instances. The query is already filtered,
+    ordered by id and limited to `limit + 1` rows (one extra row tells us whether
+    there is a next page); `limit` is None when no limit applies.
+    """
+    limit = parse_int_arg(args, "limit", default_limit)
+    if limit is not None and (limit < 1 or limit > MAX_LIMIT):
+        raise APIException("'limit' must be between 1 and " + str(MAX_LIMIT), status_code=400)
+    cursor = parse_int_arg(args, "cursor")
+    fields = parse_fields(model, args)
+    include = parse_include(model, args)
+    if fields is not None and include:
+        raise APIException("'fields' and 'include' cannot be combined", status_code=400)
+
+    if include:
+        query = model.query.options(*load_options(model, include, "selectinload"))
+    else:
+        # sin relaciones no hacen falta objetos del ORM: se leen tuplas solo con las columnas publicas
+        if fields is None:
+            fields = list(public_columns(model))
+        query = db.session.query(*[getattr(model, field) for field in fields])
+    for condition in parse_filters(model, args):
+        query = query.filter(condition)
+    if cursor is not None:
+        query = query.filter(model.id > cursor)
+    query = query.order_by(model.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query, fields, include, limit
+
+def serialize_row(row, fields, include):
+    if include:
+        return serialize_tree(row, include)
+    return dict(zip(fields, row))
+
+def get_collection(model, args):
+    """
+    Returns one page of `model` as {"response": [...], "next": cursor}.
+    `next` is None on the last page, otherwise it must be sent back as `?cursor=`.
+    """
+    query, fields, include, limit = build_query(model, args)
+    rows = query.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+
+    with timer("serialize"):
+        serialized = list(map(lambda row: serialize_row(row, fields, include), rows))
+    return {"response": serialized, "next": next_cursor}
+
+def iter_collection(query, fields, include, limit):
+    """
+    Yields (row_id, serialized_row) for every row of a `build_query` query without
+    loading the whole result in memory: rows come from a server-side cursor in batches
+    of STREAM_BATCH. If rows remain past `limit` a final None is yielded so the caller
+    can emit a next cursor.
+    """
+    query = query.execution_options(stream_results=True).yield_per(STREAM_BATCH)
+    for index, row in enumerate(query):
+        if index == limit:
+            yield None
+            return
+        yield row.id, serialize_row(row, fields, include)
+
+def stream_json(rows):
+    yield '{"response": ['
+    last_id, next_cursor = None, None
+    for item in rows:
+        if item is None:
+            next_cursor = last_id
+            break
+        yield ("" if last_id is None else ",") + json.dumps(item[1])
+        last_id = item[0]
+    yield '], "next": ' + json.dumps(next_cursor) + '}'
+
+def stream_ndjson(rows):
+    for item in rows:
+        if item is None:
+            break
+        yield json.dumps(item[1]) + "\n"
+
+def wants_ndjson(request):
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def collection_response(model, request):
+    """
+    Response for a collection GET: a paginated JSON page by default, the given rows with
+    `?ids=`, NDJSON when the client sends `Accept: application/x-ndjson`, or a chunked
+    JSON array with `?stream=true`.
+    Streams are unlimited unless the client sends `?limit=`.
+    """
+    if request.args.get("ids"):
+        return jsonify(get_batch(model, request.args)), 200
+    ndjson = wants_ndjson(request)
+    if not ndjson and request.args.get("stream") not in ("1", "true"):
+        return jsonify(get_collection(model, request.args)), 200
+    # los argumentos se validan antes de empezar a enviar la respuesta
+    rows = iter_collection(*build_query(model, request.args, default_limit=None))
+    if ndjson:
+        return Response(stream_with_context(stream_ndjson(rows)), mimetype=NDJSON_MIMETYPE)
+    return Response(stream_with_context(stream_json(rows)), mimetype="application/json")
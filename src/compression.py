@@ -0,0 +1,162 @@
+"""
+Response compression negotiated with Accept-Encoding: brotli (needs the `brotli`
+package), zstd (needs `zstandard`) and gzip, in the order of COMPRESS_ENCODINGS.
+
+- Bodies under COMPRESS_MIN_SIZE bytes are sent as they are.
+- Streamed responses (?stream=true, NDJSON) are compressed as they are produced and
+  flushed every COMPRESS_FLUSH_BYTES of input (default 32 KB): flushing after every
+  row would send each one as its own block and more than double the size.
+- Responses with an ETag (the @cached routes) keep their compressed body in the
+  response cache under the ETag and the encoding, so an unchanged payload is only
+  compressed once. The ETag turns weak, like nginx does, and still answers
+  If-None-Match with a 304.
+"""
+import os
+import threading
+import zlib
+from flask import request
+import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE = ("application/json", "application/x-ndjson", "text/")
+
+class GzipStream:
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class BrotliStream:
+    def __init__(self):
+        # calidad 4: comprime mas que gzip -6 en un tiempo parecido
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+class ZstdStream:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+CODECS = {"br": BrotliStream if brotli else None, "zstd": ZstdStream if zstandard else None, "gzip": GzipStream}
+
+stats = {"responses": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+stats_lock = threading.Lock()
+
+def count(**values):
+    with stats_lock:
+        for name, value in values.items():
+            stats[name] += value
+
+def available_encodings():
+    names = [name.strip() for name in os.environ.get('COMPRESS_ENCODINGS', 'br,zstd,gzip').split(",")]
+    return [name for name in names if CODECS.get(name)]
+
+def compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if "Content-Encoding" in response.headers or request.method == "HEAD":
+        return False
+    return response.mimetype.startswith(COMPRESSIBLE)
+
+def compress_body(data, encoding):
+    codec = CODECS[encoding]()
+    return codec.compress(data) + codec.finish()
+
+def compress_stream(body, encoding):
+    codec = CODECS[encoding]()
+    flush_bytes = int(os.environ.get('COMPRESS_FLUSH_BYTES', 32768))
+    unflushed = 0
+    try:
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if not chunk:
+                continue
+            compressed = codec.compress(chunk)
+            unflushed += len(chunk)
+            if unflushed >= flush_bytes:
+                compressed += codec.flush()
+                unflushed = 0
+            count(bytes_in=len(chunk), bytes_out=len(compressed))
+            if compressed:
+                yield compressed
+        compressed = codec.finish()
+        count(bytes_out=len(compressed))
+        yield compressed
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+def compress_response(response):
+    if not compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encodings = available_encodings()
+    encoding = request.accept_encodings.best_match(encodings) if encodings else None
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+        count(responses=1)
+    else:
+        data = response.get_data()
+        if len(data) < int(os.environ.get('COMPRESS_MIN_SIZE', 1024)):
+            return response
+        etag, weak = response.get_etag()
+        key = "compressed:" + encoding + ":" + etag if etag and cache.backend.ttl > 0 else None
+        compressed = cache.backend.get(key) if key else None
+        if compressed is not None:
+            count(responses=1, cache_hits=1)
+        else:
+            compressed = compress_body(data, encoding)
+            if key:
+                cache.backend.set(key, compressed)
+            count(responses=1, bytes_in=len(data), bytes_out=len(compressed))
+        response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+def setup_compression(app):
+    # se registra despues de setup_metrics, asi que corre antes que finish_request y
+    # las metricas cuentan los bytes comprimidos y el tiempo de comprimir
+    app.after_request(compress_response)
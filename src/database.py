@@ -0,0 +1,163 @@
+"""
+SQLAlchemy engine configuration driven by environment variables, plus connection
+pool metrics for the /health/db endpoint.
+
+- DB_MAX_CONNECTIONS: connections the whole app may open (all gunicorn workers together).
+  Each worker gets DB_MAX_CONNECTIONS / WEB_CONCURRENCY, split between pool and overflow.
+- DB_POOL_SIZE / DB_MAX_OVERFLOW: explicit per-worker sizes, they win over the budget.
+  With threaded workers (GUNICORN_CMD_ARGS="--threads N", opt-in) each worker runs N
+  requests at once, so keep pool + overflow at least N or the threads wait for a connection.
+- DB_POOL_TIMEOUT: seconds to wait for a free connection before failing.
+- DB_POOL_RECYCLE: seconds after which a connection is reopened (keep it below MySQL wait_timeout).
+- DB_POOL_PRE_PING: test connections on checkout so stale ones are replaced transparently.
+- DB_STATEMENT_TIMEOUT_MS: per statement time limit (MySQL SELECTs and PostgreSQL).
+- DB_REPLICA_CONNECTION_STRINGS / DB_REPLICA_CHECK_INTERVAL / DB_REPLICA_LAG_WINDOW: read
+  replicas, see replicas.py.
+"""
+import os
+import threading
+import time
+from sqlalchemy import event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from replicas import router
+
+pool_stats = {
+    "checkouts": 0,
+    "checkins": 0,
+    "connects": 0,
+    "invalidations": 0,
+    "timeouts": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+pool_stats_lock = threading.Lock()
+
+def record(name, amount=1):
+    with pool_stats_lock:
+        pool_stats[name] += amount
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that measures how long requests wait for a connection."""
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            record("timeouts")
+            raise
+        finally:
+            waited = time.monotonic() - started
+            with pool_stats_lock:
+                pool_stats["wait_seconds_total"] += waited
+                pool_stats["wait_seconds_max"] = max(pool_stats["wait_seconds_max"], waited)
+
+@event.listens_for(TimedQueuePool, "connect")
+def on_connect(dbapi_connection, connection_record):
+    record("connects")
+
+@event.listens_for(TimedQueuePool, "checkout")
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    record("checkouts")
+
+@event.listens_for(TimedQueuePool, "checkin")
+def on_checkin(dbapi_connection, connection_record):
+    record("checkins")
+
+@event.listens_for(TimedQueuePool, "invalidate")
+def on_invalidate(dbapi_connection, connection_record, exception):
+    record("invalidations")
+
+def env_int(name, default=None):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+def pool_sizes():
+    """Per-worker (pool_size, max_overflow) from the explicit settings or the connection budget."""
+    pool_size = env_int('DB_POOL_SIZE')
+    max_overflow = env_int('DB_MAX_OVERFLOW')
+    budget = env_int('DB_MAX_CONNECTIONS')
+    if budget is not None:
+        per_worker = max(1, budget // max(1, env_int('WEB_CONCURRENCY', 1)))
+        # la mitad fija y la otra mitad como overflow para los picos
+        if pool_size is None:
+            pool_size = max(1, per_worker - per_worker // 2)
+        if max_overflow is None:
+            max_overflow = max(0, per_worker - pool_size)
+    return (pool_size if pool_size is not None else 5, max_overflow if max_overflow is not None else 10)
+
+def engine_options(database_uri):
+    options = {"pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')}
+    url = make_url(database_uri)
+    if url.drivername.startswith("sqlite"):
+        # sqlite usa sus propios pools, que no aceptan estos parametros
+        return options
+    pool_size, max_overflow = pool_sizes()
+    options.update({
+        "poolclass": TimedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": env_int('DB_POOL_TIMEOUT', 10),
+        "pool_recycle": env_int('DB_POOL_RECYCLE', 280),
+    })
+    timeout_ms = env_int('DB_STATEMENT_TIMEOUT_MS')
+    if timeout_ms and url.drivername.startswith("postgresql"):
+        options["connect_args"] = {"options": "-c statement_timeout=" + str(timeout_ms)}
+    return options
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET SESSION MAX_EXECUTION_TIME=" + str(env_int('DB_STATEMENT_TIMEOUT_MS')))
+    cursor.close()
+
+def setup_database(app):
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not database_uri:
+        return
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_uri)
+    if env_int('DB_STATEMENT_TIMEOUT_MS') and make_url(database_uri).drivername.startswith("mysql"):
+        event.listen(TimedQueuePool, "connect", set_statement_timeout)
+    replica_uris = [uri.strip() for uri in os.environ.get('DB_REPLICA_CONNECTION_STRINGS', '').split(',') if uri.strip()]
+    if replica_uris:
+        # cada replica tiene su propio pool, con el mismo tamano por worker que el primario
+        router.configure(replica_uris, {uri: engine_options(uri) for uri in replica_uris},
+                         check_interval=env_int('DB_REPLICA_CHECK_INTERVAL', 30),
+                         lag_window=env_int('DB_REPLICA_LAG_WINDOW', 5))
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {"pool_class": type(pool).__name__, "pid": os.getpid()}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(0, pool._max_overflow)
+        status.update({
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "saturation": round(pool.checkedout() / capacity, 3) if capacity else None,
+        })
+    with pool_stats_lock:
+        status.update(pool_stats)
+    return status
+
+def check_database(engine):
+    """Returns (healthy, report) after a `SELECT 1` round trip."""
+    started = time.monotonic()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        healthy, error = True, None
+    except SQLAlchemyError as exception:
+        healthy, error = False, str(exception.__class__.__name__) + ": " + str(exception)
+    report = {
+        "healthy": healthy,
+        "latency_ms": round((time.monotonic() - started) * 1000, 2),
+        "pool": pool_status(engine),
+    }
+    if error:
+        report["error"] = error
+    if router.replicas:
+        report["replicas"] = router.status()
+    return healthy, report
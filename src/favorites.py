@@ -0,0 +1,71 @@
+"""
+Favorites: the write paths shared by the single and bulk endpoints, and the user
+dashboard that resolves a page of favorites into full entities.
+"""
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Character, Planet, Vehicle, Favorite
+from utils import APIException
+from collection import DEFAULT_LIMIT, MAX_LIMIT, parse_int_arg, fetch_by_ids
+from popularity import adjust_counts
+
+KINDS = (("characters", "character_id", Character), ("planets", "planet_id", Planet), ("vehicles", "vehicle_id", Vehicle))
+
+def add_favorite(user_id, **target):
+    """
+    Inserts the favorite unless the user already has it (upsert that does nothing on
+    duplicates, enforced by the unique indexes on favorite). Returns (favorite, created).
+    The popularity counter of the item goes up in the same transaction (on flush, see
+    popularity.py).
+    """
+    favorite = Favorite(user_id=user_id, **target)
+    db.session.add(favorite)
+    try:
+        db.session.commit()
+        return favorite, True
+    except IntegrityError:
+        db.session.rollback()
+    existing = Favorite.query.filter_by(user_id=user_id, **target).first()
+    if existing is None:
+        # no era un duplicado: el usuario o el item no existen
+        raise APIException("User or " + list(target)[0].replace("_id", "") + " not found", status_code=404)
+    return existing, False
+
+def remove_favorite(user_id, **target):
+    """Deletes the favorite and lowers the popularity counter of the item, or 404s."""
+    deleted = Favorite.query.filter_by(user_id=user_id, **target).delete(synchronize_session=False)
+    if not deleted:
+        db.session.rollback()
+        raise APIException("Favorite not found", status_code=404)
+    adjust_counts([target], -1)
+    db.session.commit()
+
+def user_dashboard(user_id, args):
+    """
+    The user with one page of favorites (keyset on favorite id, ?cursor= / ?limit=)
+    resolved into full characters, planets and vehicles, grouped by kind. Always at
+    most five queries: user, favorites page and one IN query per entity type.
+    """
+    limit = parse_int_arg(args, "limit", DEFAULT_LIMIT)
+    if limit < 1 or limit > MAX_LIMIT:
+        raise APIException("'limit' must be between 1 and " + str(MAX_LIMIT), status_code=400)
+    cursor = parse_int_arg(args, "cursor")
+    user = User.query.get(user_id)
+    if user is None:
+        raise APIException("User not found", status_code=404)
+
+    query = db.session.query(Favorite.id, Favorite.character_id, Favorite.planet_id, Favorite.vehicle_id)
+    query = query.filter(Favorite.user_id == user_id)
+    if cursor is not None:
+        query = query.filter(Favorite.id > cursor)
+    favorites = query.order_by(Favorite.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(favorites) > limit:
+        favorites = favorites[:limit]
+        next_cursor = favorites[-1].id
+
+    grouped = {}
+    for kind, column, model in KINDS:
+        entities = fetch_by_ids(model, [getattr(favorite, column) for favorite in favorites if getattr(favorite, column) is not None])
+        grouped[kind] = [dict(entities[getattr(favorite, column)], favorite_id=favorite.id)
+                         for favorite in favorites if getattr(favorite, column) in entities]
+    return {"user": user.serialize(), "favorites": grouped, "next": next_cursor}
@@ -2,38 +2,124 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+import logging
+import time
+from flask import Flask, Blueprint, Response, current_app, request, jsonify, url_for
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from utils import APIException, LazyMount, env_flag, generate_sitemap, route_catalog
+from collection import collection_response, get_one, parse_include, load_options, serialize_tree
+from cache import setup_cache, cached, get_stats
+from bulk import bulk_create, bulk_delete, delete_one
+from favorites import add_favorite, remove_favorite, user_dashboard
+from search import search
+from popularity import setup_popularity, leaderboard
+from database import setup_database, check_database
+from metrics import setup_metrics, render_metrics
+from compression import setup_compression
+from ratelimit import setup_rate_limit, limit_concurrency
+from snapshot import setup_snapshot, snapshot_one, snapshot_collection
+from transfer import setup_transfer
+from writebehind import setup_write_behind, enqueue_favorite, overlay_favorites, overlay_dashboard, queue_marker
+from writebehind import enabled as write_behind_enabled
 from models import  db, User, Character, Planet, Vehicle, Favorite
 #from models import User, Character, Planet, Vehicle, Favorite
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+api = Blueprint('api', __name__)
+startup_logger = logging.getLogger("startup")
+
+def create_admin_app(app):
+    # flask_admin solo se importa con la primera peticion a /admin
+    from admin import setup_admin
+    admin_app = Flask(app.import_name)
+    admin_app.config.update(app.config)
+    #comparte el estado de flask_sqlalchemy con la API: el mismo engine y el mismo pool,
+    #dentro del presupuesto de DB_MAX_CONNECTIONS, en vez de un segundo pool por worker
+    admin_app.extensions['sqlalchemy'] = app.extensions['sqlalchemy']
+    admin_app.teardown_appcontext(remove_session)
+    setup_admin(admin_app)
+    return admin_app
+
+def remove_session(exception):
+    db.session.remove()
+
+def swagger_spec():
+    from flask_swagger import swagger
+    return jsonify(swagger(current_app)), 200
+
+def create_app(config=None):
+    """
+    Builds the API app. Optional parts are toggled with FEATURE_ADMIN (default on),
+    FEATURE_CORS (default on) and FEATURE_SWAGGER (/swagger.json, default off), or
+    with the same keys in `config`. The admin is built on the first request to /admin,
+    and Flask-Migrate (which pulls in alembic) is only set up under the `flask` CLI.
+    With STARTUP_PROFILE=true the time of every step is logged on the `startup` logger.
+    """
+    timings = []
+    def step(name, setup, *args):
+        started = time.perf_counter()
+        setup(*args)
+        timings.append((name, time.perf_counter() - started))
+
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['FEATURE_ADMIN'] = env_flag('FEATURE_ADMIN', True)
+    app.config['FEATURE_CORS'] = env_flag('FEATURE_CORS', True)
+    app.config['FEATURE_SWAGGER'] = env_flag('FEATURE_SWAGGER', False)
+    app.config.update(config or {})
+
+    step("database", setup_database, app)
+    step("sqlalchemy", db.init_app, app)
+    if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        def setup_migrate(app):
+            from flask_migrate import Migrate
+            Migrate(app, db)
+        step("migrate", setup_migrate, app)
+    if app.config['FEATURE_CORS']:
+        step("cors", CORS, app)
+    step("cache", setup_cache, app)
+    step("metrics", setup_metrics, app)
+    step("rate limit", setup_rate_limit, app)
+    step("compression", setup_compression, app)
+    step("popularity", setup_popularity, app)
+    step("write behind", setup_write_behind, app)
+    step("snapshot", setup_snapshot, app)
+    step("transfer", setup_transfer, app)
+    step("routes", app.register_blueprint, api)
+    if app.config['FEATURE_SWAGGER']:
+        app.add_url_rule('/swagger.json', 'swagger_spec', swagger_spec)
+    if app.config['FEATURE_ADMIN']:
+        app.wsgi_app = LazyMount(app.wsgi_app, '/admin', lambda: create_admin_app(app))
+    step("sitemap", route_catalog, app)
+
+    app.extensions['startup'] = timings
+    if env_flag('STARTUP_PROFILE', False):
+        for name, seconds in timings:
+            startup_logger.warning("%-12s %8.1f ms", name, seconds * 1000)
+        startup_logger.warning("%-12s %8.1f ms", "total", sum(seconds for name, seconds in timings) * 1000)
+    return app
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    #el HTML se genera una sola vez al arrancar (ver route_catalog en utils.py)
+    return generate_sitemap(current_app)
+
+@api.route('/routes', methods=['GET'])
+def get_route_catalog():
+    """Every route with its methods and path parameters."""
+    return jsonify ({"response": route_catalog(current_app)}), 200
 
 #ENDPOINTS DE USER (POST, GET, GET ONE, DELETE, POST CHARACTER/PLANET/VEHICLE FAVORITE
 # DELETE CHARACTER/PLANET/VEHICLE FAVORITE)
 
-@app.route('/user', methods=['POST'])
+@api.route('/user', methods=['POST'])
 def create_user():
     #aca vendría lo que se indica desde React
     #body_name = request.json.get (Lo utilizaremos cuando necesitamos agarrar el valor de una key dentro de un JSON, una string JSON)
@@ -51,79 +137,91 @@ def create_user():
     db.session.commit()
     return jsonify({"name" : user.name, "msg" : "creado el usuario con id: " + str(user.id)}), 200
 
-@app.route('/user', methods=['GET'])
+@api.route('/user', methods=['GET'])
+@cached("user", "favorite", "character", "planet", "vehicle")
+@limit_concurrency()
 def get_all_users():
-    users = User.query.all() #esto me devuelve una lista de instancia de clases, que hay que hacerles serialize
-    users_serialized = list(map(lambda x: x.serialize(), users))
-    return jsonify ({"response": users_serialized}), 200
+    #pagina por id con ?cursor=, ?limit=, ?fields= y filtros por columnas indexadas; ?stream=true o NDJSON para todo
+    return collection_response(User, request)
 
-@app.route('/user/<int:user_id>', methods=['GET'])
+@api.route('/user/<int:user_id>', methods=['GET'])
+@cached("user", "favorite", "character", "planet", "vehicle", extra_key=queue_marker)
 def get_one_user(user_id):
-    user = User.query.filter_by(id=user_id).first() 
-    return jsonify ({"response": user.serialize()}), 200
-
-@app.route('/user/<int:user_id>/favorites', methods=['GET'])
+    #los favoritos solo se devuelven con ?include=favorites, cargados en la misma query
+    user = get_one(User, user_id, request.args)
+    if "favorites" in user:
+        #con FAVORITES_WRITE_BEHIND se suman los cambios que aun estan en la cola
+        user["favorites"] = overlay_favorites(user_id, user["favorites"], parse_include(User, request.args)["favorites"])
+    return jsonify ({"response": user}), 200
+
+@api.route('/user/<int:user_id>/favorites', methods=['GET'])
+@cached("favorite", "character", "planet", "vehicle", extra_key=queue_marker)
+@limit_concurrency()
 def get_one_user_favorites(user_id):
-    favo = Favorite.query.filter(Favorite.user_id == user_id).all()
-    favo_serialized = list(map(lambda x: x.serialize(), favo))    
-    return jsonify ({"result": favo_serialized}), 200
+    include = parse_include(Favorite, request.args)
+    favo = Favorite.query.options(*load_options(Favorite, include, "selectinload")).filter(Favorite.user_id == user_id).all()
+    favo_serialized = list(map(lambda x: serialize_tree(x, include), favo))
+    #con FAVORITES_WRITE_BEHIND se suman los cambios que aun estan en la cola
+    return jsonify ({"result": overlay_favorites(user_id, favo_serialized, include)}), 200
+
 
+@api.route('/user/<int:user_id>/dashboard', methods=['GET'])
+@cached("user", "favorite", "character", "planet", "vehicle", extra_key=queue_marker)
+@limit_concurrency()
+def get_one_user_dashboard(user_id):
+    #el usuario con sus favoritos ya resueltos, agrupados por tipo, para no pedirlos uno a uno
+    return jsonify ({"response": overlay_dashboard(user_id, user_dashboard(user_id, request.args))}), 200
 
-@app.route('/user/<int:user_id>', methods=['DELETE'])
+@api.route('/user/<int:user_id>', methods=['DELETE'])
 def delete_one_user(user_id):
-    user = User.query.filter_by(id = user_id).first() 
-    db.session.delete(user)
-    db.session.commit()
-    return jsonify ({"deleted":True}), 200
+    #borra tambien sus favoritos con un DELETE ... WHERE, sin cargarlos en memoria
+    return jsonify (delete_one(User, user_id)), 200
 
-@app.route('/user/<int:user_id>/favorite/character/<int:ch_id>', methods=['POST'])
+@api.route('/user/<int:user_id>/favorite/character/<int:ch_id>', methods=['POST'])
 def favorite_character(ch_id, user_id):
-    user = User.query.get(user_id)
-    new_favorite = Favorite(user_id = user_id, character_id = ch_id)
-    db.session.add(new_favorite)
-    db.session.commit()
-    return jsonify ({"created": True, "character": new_favorite.serialize()}), 200
+    if write_behind_enabled():
+        return jsonify (enqueue_favorite(user_id, "add", character_id = ch_id)), 202
+    favorite, created = add_favorite(user_id, character_id = ch_id)
+    return jsonify ({"created": created, "character": favorite.serialize()}), 200
 
-@app.route('/user/<int:user_id>/favorite/planet/<int:pl_id>', methods=['POST'])
+@api.route('/user/<int:user_id>/favorite/planet/<int:pl_id>', methods=['POST'])
 def favorite_planet(pl_id, user_id):
-    user = User.query.get(user_id)
-    new_favorite = Favorite(user_id = user_id, planet_id = pl_id)
-    db.session.add(new_favorite)
-    db.session.commit()
-    return jsonify ({"created": True, "planet": new_favorite.serialize()}), 200
+    if write_behind_enabled():
+        return jsonify (enqueue_favorite(user_id, "add", planet_id = pl_id)), 202
+    favorite, created = add_favorite(user_id, planet_id = pl_id)
+    return jsonify ({"created": created, "planet": favorite.serialize()}), 200
 
-@app.route('/user/<int:user_id>/favorite/vehicle/<int:vh_id>', methods=['POST'])
+@api.route('/user/<int:user_id>/favorite/vehicle/<int:vh_id>', methods=['POST'])
 def favorite_vehicle(vh_id, user_id):
-    user = User.query.get(user_id)
-    new_favorite = Favorite(user_id = user_id, vehicle_id = vh_id)
-    db.session.add(new_favorite)
-    db.session.commit()
-    return jsonify ({"created": True, "vehicle": new_favorite.serialize()}), 200
+    if write_behind_enabled():
+        return jsonify (enqueue_favorite(user_id, "add", vehicle_id = vh_id)), 202
+    favorite, created = add_favorite(user_id, vehicle_id = vh_id)
+    return jsonify ({"created": created, "vehicle": favorite.serialize()}), 200
 
-@app.route('/user/<int:user_id>/favorite/character/<int:ch_id>', methods=['DELETE'])
+@api.route('/user/<int:user_id>/favorite/character/<int:ch_id>', methods=['DELETE'])
 def delete_favorite_character_by_id(ch_id, user_id):
-    fav = Favorite.query.filter_by(user_id = user_id).filter_by(character_id = ch_id).first()
-    db.session.delete(fav)
-    db.session.commit()
+    if write_behind_enabled():
+        return jsonify (enqueue_favorite(user_id, "remove", character_id = ch_id)), 202
+    remove_favorite(user_id, character_id = ch_id)
     return jsonify({"deleted": True}), 200
 
-@app.route('/user/<int:user_id>/favorite/planet/<int:pl_id>', methods=['DELETE'])
+@api.route('/user/<int:user_id>/favorite/planet/<int:pl_id>', methods=['DELETE'])
 def delete_favorite_planet_by_id(pl_id, user_id):
-    fav = Favorite.query.filter_by(user_id = user_id).filter_by(planet_id = pl_id).first()
-    db.session.delete(fav)
-    db.session.commit()
+    if write_behind_enabled():
+        return jsonify (enqueue_favorite(user_id, "remove", planet_id = pl_id)), 202
+    remove_favorite(user_id, planet_id = pl_id)
     return jsonify({"deleted": True}), 200
 
-@app.route('/user/<int:user_id>/favorite/vehicle/<int:vh_id>', methods=['DELETE'])
+@api.route('/user/<int:user_id>/favorite/vehicle/<int:vh_id>', methods=['DELETE'])
 def delete_favorite_vehicle_by_id(vh_id, user_id):
-    fav = Favorite.query.filter_by(user_id = user_id).filter_by(vehicle_id = vh_id).first()
-    db.session.delete(fav)
-    db.session.commit()
+    if write_behind_enabled():
+        return jsonify (enqueue_favorite(user_id, "remove", vehicle_id = vh_id)), 202
+    remove_favorite(user_id, vehicle_id = vh_id)
     return jsonify({"deleted": True}), 200
 
 #ENDPOINTS DE CHARACTER (POST, GET, GET ONE, DELETE)
 
-@app.route('/character', methods=['POST'])
+@api.route('/character', methods=['POST'])
 def create_character():
     body_name = request.json.get("name")
     body_age = request.json.get("age")
@@ -134,27 +232,42 @@ def create_character():
     db.session.commit()
     return jsonify({"name" : character.name, "msg" : "creado el character con id: " + str(character.id)}), 200
 
-@app.route('/character', methods=['GET'])
+@api.route('/character', methods=['GET'])
+@cached("character")
+@limit_concurrency()
 def get_all_characters():
-    characters = Character.query.all() #esto me devuelve una lista de instancia de clases, que hay que hacerles serialize
-    characters_serialized = list(map(lambda x: x.serialize(), characters))
-    return jsonify ({"response": characters_serialized}), 200
+    #con SNAPSHOT_TABLES las paginas simples salen de memoria
+    response = snapshot_collection(Character, request)
+    return response if response is not None else collection_response(Character, request)
 
-@app.route('/character/<int:character_id>', methods=['GET'])
+@api.route('/character/<int:character_id>', methods=['GET'])
+@cached("character")
 def get_one_character(character_id):
+    response = snapshot_one(Character, character_id)
+    if response is not None:
+        return response
     character = Character.query.filter_by(id=character_id).first() 
     return jsonify ({"response": character.serialize()}), 200
 
-@app.route('/character/<int:character_id>', methods=['DELETE'])
+@api.route('/character/<int:character_id>', methods=['DELETE'])
 def delete_one_character(character_id):
-    character = Character.query.filter_by(id = character_id).first() 
-    db.session.delete(character)
-    db.session.commit()
-    return jsonify ({"deleted":True}), 200
+    #borra tambien sus favoritos con un DELETE ... WHERE, sin cargarlos en memoria
+    return jsonify (delete_one(Character, character_id)), 200
+
+@api.route('/character/bulk', methods=['POST'])
+@limit_concurrency()
+def create_characters_bulk():
+    #JSON array o NDJSON, insertado por bloques de ?chunk_size= en una sola transaccion
+    return jsonify(bulk_create(Character, request)), 200
+
+@api.route('/character/bulk', methods=['DELETE'])
+@limit_concurrency()
+def delete_characters_bulk():
+    return jsonify(bulk_delete(Character, request)), 200
 
 #ENDPOINTS DE PLANET (POST, GET, GET ONE, DELETE)
 
-@app.route('/planet', methods=['POST'])
+@api.route('/planet', methods=['POST'])
 def create_planet():
     body_name = request.json.get("name")
     body_gravity = request.json.get("gravity")
@@ -166,63 +279,138 @@ def create_planet():
     db.session.commit()
     return jsonify({"name" : planet.name, "msg" : "creado el planet con id: " + str(planet.id)}), 200
 
-@app.route('/planet', methods=['GET'])
+@api.route('/planet', methods=['GET'])
+@cached("planet")
+@limit_concurrency()
 def get_all_planets():
-    planets = Planet.query.all() #esto me devuelve una lista de instancia de clases, que hay que hacerles serialize
-    planets_serialized = list(map(lambda x: x.serialize(), planets))
-    return jsonify ({"response": planets_serialized}), 200
+    #con SNAPSHOT_TABLES las paginas simples salen de memoria
+    response = snapshot_collection(Planet, request)
+    return response if response is not None else collection_response(Planet, request)
 
-@app.route('/planet/<int:planet_id>', methods=['GET'])
+@api.route('/planet/<int:planet_id>', methods=['GET'])
+@cached("planet")
 def get_one_planet(planet_id):
+    response = snapshot_one(Planet, planet_id)
+    if response is not None:
+        return response
     planet = Planet.query.filter_by(id=planet_id).first() 
     return jsonify ({"response": planet.serialize()}), 200
 
-@app.route('/planet/<int:planet_id>', methods=['DELETE'])
+@api.route('/planet/<int:planet_id>', methods=['DELETE'])
 def delete_one_planet(planet_id):
-    planet = Planet.query.filter_by(id = planet_id).first() 
-    db.session.delete(planet)
-    db.session.commit()
-    return jsonify ({"deleted":True}), 200
+    #borra tambien sus favoritos con un DELETE ... WHERE, sin cargarlos en memoria
+    return jsonify (delete_one(Planet, planet_id)), 200
+
+@api.route('/planet/bulk', methods=['POST'])
+@limit_concurrency()
+def create_planets_bulk():
+    #JSON array o NDJSON, insertado por bloques de ?chunk_size= en una sola transaccion
+    return jsonify(bulk_create(Planet, request)), 200
+
+@api.route('/planet/bulk', methods=['DELETE'])
+@limit_concurrency()
+def delete_planets_bulk():
+    return jsonify(bulk_delete(Planet, request)), 200
 
 #ENDPOINTS DE VEHICLE (POST, GET, GET ONE, DELETE)
 
-@app.route('/vehicle', methods=['POST'])
+@api.route('/vehicle', methods=['POST'])
 def create_vehicle():
     body_name = request.json.get("name")
-    body_gravity = request.json.get("gravity")
-    body_population = request.json.get("population")
-    body_climate = request.json.get("climate")
-    body_terrain = request.json.get("terrain")
-    vehicle = Vehicle(name = body_name, gravity = body_gravity, population = body_population, climate = body_climate, terrain = body_terrain)
+    body_model = request.json.get("model")
+    body_capacity = request.json.get("capacity")
+    body_vehicle_class = request.json.get("vehicle_class")
+    vehicle = Vehicle(name = body_name, model = body_model, capacity = body_capacity, vehicle_class = body_vehicle_class)
     db.session.add(vehicle)
     db.session.commit()
     return jsonify({"name" : vehicle.name, "msg" : "creado el vehicle con id: " + str(vehicle.id)}), 200
 
-@app.route('/vehicle', methods=['GET'])
+@api.route('/vehicle', methods=['GET'])
+@cached("vehicle")
+@limit_concurrency()
 def get_all_vehicles():
-    vehicles = Vehicle.query.all() #esto me devuelve una lista de instancia de clases, que hay que hacerles serialize
-    vehicles_serialized = list(map(lambda x: x.serialize(), vehicles))
-    return jsonify ({"response": vehicles_serialized}), 200
+    #con SNAPSHOT_TABLES las paginas simples salen de memoria
+    response = snapshot_collection(Vehicle, request)
+    return response if response is not None else collection_response(Vehicle, request)
 
-@app.route('/vehicle/<int:vehicle_id>', methods=['GET'])
+@api.route('/vehicle/<int:vehicle_id>', methods=['GET'])
+@cached("vehicle")
 def get_one_vehicle(vehicle_id):
+    response = snapshot_one(Vehicle, vehicle_id)
+    if response is not None:
+        return response
     vehicle = Vehicle.query.filter_by(id=vehicle_id).first() 
     return jsonify ({"response": vehicle.serialize()}), 200
 
-@app.route('/vehicle/<int:vehicle_id>', methods=['DELETE'])
+@api.route('/vehicle/<int:vehicle_id>', methods=['DELETE'])
 def delete_one_vehicle(vehicle_id):
-    vehicle = Vehicle.query.filter_by(id = vehicle_id).first() 
-    db.session.delete(vehicle)
-    db.session.commit()
-    return jsonify ({"deleted":True}), 200
+    #borra tambien sus favoritos con un DELETE ... WHERE, sin cargarlos en memoria
+    return jsonify (delete_one(Vehicle, vehicle_id)), 200
+
+@api.route('/vehicle/bulk', methods=['POST'])
+@limit_concurrency()
+def create_vehicles_bulk():
+    #JSON array o NDJSON, insertado por bloques de ?chunk_size= en una sola transaccion
+    return jsonify(bulk_create(Vehicle, request)), 200
+
+@api.route('/vehicle/bulk', methods=['DELETE'])
+@limit_concurrency()
+def delete_vehicles_bulk():
+    return jsonify(bulk_delete(Vehicle, request)), 200
 
-#ENDPOINT DE GET FAVORITE
+#ENDPOINTS DE FAVORITE (GET, POST BULK, DELETE BULK)
 
-@app.route('/favorite', methods=['GET'])
+@api.route('/favorite', methods=['GET'])
+@cached("favorite", "character", "planet", "vehicle")
+@limit_concurrency()
 def get_all_favorites():
-    favorites = Favorite.query.all() #esto me devuelve una lista de instancia de clases, que hay que hacerles serialize
-    favorites_serialized = list(map(lambda x: x.serialize(), favorites))
-    return jsonify ({"response": favorites_serialized}), 200
+    return collection_response(Favorite, request)
+
+@api.route('/favorite/bulk', methods=['POST'])
+@limit_concurrency()
+def create_favorites_bulk():
+    return jsonify(bulk_create(Favorite, request)), 200
+
+@api.route('/favorite/bulk', methods=['DELETE'])
+@limit_concurrency()
+def delete_favorites_bulk():
+    return jsonify(bulk_delete(Favorite, request)), 200
+
+#ENDPOINT DE BUSQUEDA POR NOMBRE (?q=, ?mode=prefix|fuzzy, ?kind=, ?limit=, ?offset=)
+
+@api.route('/search', methods=['GET'])
+@cached("character", "planet", "vehicle")
+@limit_concurrency()
+def search_by_name():
+    return jsonify(search(request.args)), 200
+
+#ENDPOINT DE LOS MAS FAVORITOS (character, planet o vehicle, ?limit=)
+
+@api.route('/leaderboard/<kind>', methods=['GET'])
+@cached("favorite", "character", "planet", "vehicle")
+def get_leaderboard(kind):
+    return jsonify ({"response": leaderboard(kind, request.args)}), 200
+
+#ENDPOINT DE SALUD DE LA BASE DE DATOS
+
+@api.route('/health/db', methods=['GET'])
+def get_database_health():
+    healthy, report = check_database(db.engine)
+    return jsonify(report), 200 if healthy else 503
+
+#ENDPOINT DE METRICAS (formato Prometheus)
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+#ENDPOINT DE ESTADISTICAS DE CACHE
+
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(get_stats()), 200
+
+app = create_app()
 
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+"""
+Request instrumentation: per-endpoint latency histograms, SQL query count and time,
+serialization time and response size, exposed in Prometheus text format on /metrics
+and per response in a `Server-Timing` header.
+
+Numbers are kept per process and every sample carries a `pid` label: with several
+gunicorn workers each scrape is answered by one of them, and the label keeps their
+counters apart as separate series instead of one series that jumps back and forth.
+Aggregate across workers in the queries, e.g.
+`sum without (pid) (rate(swapi_request_duration_seconds_count[5m]))`.
+
+Set SLOW_QUERY_MS to log every statement slower than that, with the endpoint that
+issued it, on the `slow_query` logger.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from serialization import FastJSONEncoder
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+slow_query_logger = logging.getLogger("slow_query")
+
+class EndpointStats:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.duration = 0.0
+        self.sql_queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.response_bytes = 0
+
+endpoints = {}
+endpoints_lock = threading.Lock()
+
+def slow_query_ms():
+    value = os.environ.get('SLOW_QUERY_MS')
+    return float(value) if value else None
+
+@contextmanager
+def timer(name):
+    """Adds the time spent in the block to the current request's `name` timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and hasattr(g, "timings"):
+            g.timings[name] = g.timings.get(name, 0.0) + time.perf_counter() - started
+
+class TimedJSONEncoder(FastJSONEncoder):
+    def encode(self, o):
+        with timer("serialize"):
+            return super().encode(o)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    if not has_request_context() or not hasattr(g, "timings"):
+        return
+    g.sql_queries += 1
+    g.timings["db"] = g.timings.get("db", 0.0) + elapsed
+    threshold = slow_query_ms()
+    if threshold is not None and elapsed * 1000 >= threshold:
+        slow_query_logger.warning("%.1fms in %s %s (%s): %s", elapsed * 1000, request.method,
+                                  request.path, request.endpoint, statement)
+
+def start_request():
+    g.started = time.perf_counter()
+    g.timings = {}
+    g.sql_queries = 0
+
+def finish_request(response):
+    if not hasattr(g, "started"):
+        return response
+    duration = time.perf_counter() - g.started
+    if response.content_length is not None:
+        size = response.content_length
+    elif not response.is_streamed:
+        size = len(response.get_data())
+    else:
+        size = 0
+    key = (request.endpoint or "unknown", request.method, str(response.status_code))
+    with endpoints_lock:
+        stats = endpoints.setdefault(key, EndpointStats())
+        stats.count += 1
+        stats.duration += duration
+        for position, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                stats.buckets[position] += 1
+        stats.sql_queries += g.sql_queries
+        stats.db_seconds += g.timings.get("db", 0.0)
+        stats.serialize_seconds += g.timings.get("serialize", 0.0)
+        stats.response_bytes += size
+    timings = ['total;dur=%.2f' % (duration * 1000),
+               'db;dur=%.2f;desc="%d queries"' % (g.timings.get("db", 0.0) * 1000, g.sql_queries)]
+    if "serialize" in g.timings:
+        timings.append('serialize;dur=%.2f' % (g.timings["serialize"] * 1000))
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+def setup_metrics(app):
+    app.json_encoder = TimedJSONEncoder
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+def labels(**values):
+    values = dict(pid=os.getpid(), **values)
+    return "{" + ",".join(name + '="' + str(value).replace('"', '\\"') + '"' for name, value in values.items()) + "}"
+
+def metric(lines, name, kind, help_text, samples):
+    lines.append("# HELP " + name + " " + help_text)
+    lines.append("# TYPE " + name + " " + kind)
+    for sample_labels, value in samples:
+        lines.append(name + sample_labels + " " + str(value))
+
+def render_metrics():
+    from cache import get_stats
+    from compression import get_stats as get_compression_stats
+    from database import pool_stats, pool_stats_lock
+    from writebehind import queue as favorite_queue
+    from ratelimit import get_stats as get_rate_limit_stats
+
+    lines = []
+    with endpoints_lock:
+        snapshot = sorted(endpoints.items())
+    histogram = []
+    for (endpoint, method, status), stats in snapshot:
+        for bound, value in zip(BUCKETS, stats.buckets):
+            histogram.append(("_bucket" + labels(endpoint=endpoint, method=method, status=status, le=bound), value))
+        histogram.append(("_bucket" + labels(endpoint=endpoint, method=method, status=status, le="+Inf"), stats.count))
+        histogram.append(("_sum" + labels(endpoint=endpoint, method=method, status=status), stats.duration))
+        histogram.append(("_count" + labels(endpoint=endpoint, method=method, status=status), stats.count))
+    metric(lines, "swapi_request_duration_seconds", "histogram", "Request latency by endpoint.", histogram)
+    for name, attribute, help_text in [
+        ("swapi_sql_queries_total", "sql_queries", "SQL statements executed by endpoint."),
+        ("swapi_db_seconds_total", "db_seconds", "Time spent in SQL statements by endpoint."),
+        ("swapi_serialize_seconds_total", "serialize_seconds", "Time spent serializing responses by endpoint."),
+        ("swapi_response_bytes_total", "response_bytes", "Response body bytes by endpoint (streamed bodies excluded)."),
+    ]:
+        metric(lines, name, "counter", help_text,
+               [(labels(endpoint=endpoint, method=method, status=status), getattr(stats, attribute))
+                for (endpoint, method, status), stats in snapshot])
+
+    cache_stats = get_stats()
+    metric(lines, "swapi_cache_hits_total", "counter", "Response cache hits.", [(labels(), cache_stats["hits"])])
+    metric(lines, "swapi_cache_misses_total", "counter", "Response cache misses.", [(labels(), cache_stats["misses"])])
+    compression = get_compression_stats()
+    metric(lines, "swapi_compressed_responses_total", "counter", "Responses sent compressed.", [(labels(), compression["responses"])])
+    metric(lines, "swapi_compression_cache_hits_total", "counter", "Compressed bodies reused from the response cache.",
+           [(labels(), compression["cache_hits"])])
+    metric(lines, "swapi_compression_bytes_in_total", "counter", "Bytes compressed (cache hits excluded).",
+           [(labels(), compression["bytes_in"])])
+    metric(lines, "swapi_compression_bytes_out_total", "counter", "Compressed bytes produced (cache hits excluded).",
+           [(labels(), compression["bytes_out"])])
+    with pool_stats_lock:
+        pool = dict(pool_stats)
+    for name in ("checkouts", "connects", "invalidations", "timeouts", "wait_seconds_total"):
+        metric(lines, "swapi_db_pool_" + name.replace("_total", "") + "_total", "counter",
+               "Connection pool " + name.replace("_", " ") + ".", [(labels(), pool[name])])
+    admission = get_rate_limit_stats()
+    metric(lines, "swapi_rate_limit_allowed_total", "counter", "Requests that got a rate limit token.", [(labels(), admission["allowed"])])
+    metric(lines, "swapi_rate_limit_rejected_total", "counter", "Requests answered with 429 by the rate limiter.",
+           [(labels(), admission["limited"])])
+    metric(lines, "swapi_concurrency_shed_total", "counter", "Requests answered with 503 by the concurrency cap.",
+           [(labels(endpoint=endpoint), value) for endpoint, value in sorted(admission["shed"].items())])
+    if favorite_queue is not None:
+        metric(lines, "swapi_favorite_queue_depth", "gauge", "Favorite operations waiting in the write-behind queue.",
+               [(labels(), favorite_queue.depth())])
+    return "\n".join(lines) + "\n"
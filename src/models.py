@@ -1,8 +1,23 @@
-from flask_sqlalchemy import SQLAlchemy
+from replicas import RoutingSQLAlchemy
+from serialization import column_serializer
 
-db = SQLAlchemy()
-    
-class User(db.Model):
+# igual que SQLAlchemy(), pero las peticiones GET pueden leer de replicas (ver replicas.py)
+db = RoutingSQLAlchemy()
+
+class Serializable:
+    # serialize() devuelve todas las columnas menos las de hidden_fields, con una funcion
+    # generada una sola vez por modelo (ver serialization.py)
+    def serialize(self):
+        return column_serializer(type(self))(self)
+
+class Popular:
+    # cuantos usuarios lo tienen como favorito, mantenido por popularity.py para no hacer
+    # COUNT(*) sobre favorite; no se devuelve ni se escribe desde la API
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0", index=True)
+    hidden_fields = ("favorite_count",)
+    counter_fields = ("favorite_count",)
+
+class User(Serializable, db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
@@ -10,92 +25,58 @@ class User(db.Model):
     email = db.Column(db.String(250), nullable=False, unique=True)
     password = db.Column(db.String(250))
     favorite = db.relationship("Favorite", backref="User")
+    # columnas que nunca se devuelven ni se pueden filtrar desde la API
+    hidden_fields = ("password",)
+    # relaciones que se pueden expandir con ?include=
+    relations = {"favorites": "favorite"}
        
     def __repr__(self):
         return "user: " + self.username
-    
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "email": self.email,
-            "favorite": list(map(lambda favo: favo.serialize(), self.favorite))
-        }
-      
-class Character(db.Model):
+
+class Character(Popular, Serializable, db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
-    age = db.Column(db.Integer, nullable=False)
-    gender = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
+    age = db.Column(db.Integer, nullable=False, index=True)
+    gender = db.Column(db.String(250), nullable=False, index=True)
     skin_color = db.Column(db.String(250), nullable=False)
-    
-    
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "age": self.age,
-            "gender": self.gender,
-            "skin_color": self.skin_color
-        } 
 
-class Planet(db.Model):
+class Planet(Popular, Serializable, db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
     gravity = db.Column(db.Integer, nullable=False)
-    population = db.Column(db.Integer, nullable=False)
-    climate = db.Column(db.String(250), nullable=False)
-    terrain = db.Column(db.String(250), nullable=False)
-    
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "gravity": self.gravity,
-            "population": self.population,
-            "climate": self.climate,
-            "terrain": self.terrain
-        }     
-        
-class Vehicle(db.Model):
+    population = db.Column(db.Integer, nullable=False, index=True)
+    climate = db.Column(db.String(250), nullable=False, index=True)
+    terrain = db.Column(db.String(250), nullable=False, index=True)
+
+class Vehicle(Popular, Serializable, db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
-    model = db.Column(db.String(250), nullable=False)
-    capacity = db.Column(db.Integer, nullable=False)
-    vehicle_class = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
+    model = db.Column(db.String(250), nullable=False, index=True)
+    capacity = db.Column(db.Integer, nullable=False, index=True)
+    vehicle_class = db.Column(db.String(250), nullable=False, index=True)
+
+
+class Favorite(Serializable, db.Model):
+    # un usuario solo puede tener cada character/planet/vehicle una vez como favorito.
+    # Los NULL no chocan en un indice unique, asi que cada indice solo aplica a su tipo
+    __table_args__ = (
+        db.Index("ix_favorite_user_character", "user_id", "character_id", unique=True),
+        db.Index("ix_favorite_user_planet", "user_id", "planet_id", unique=True),
+        db.Index("ix_favorite_user_vehicle", "user_id", "vehicle_id", unique=True),
+    )
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "model": self.model,
-            "capacity": self.capacity,
-            "vehicle_class": self.vehicle_class
-        }     
-
-class Favorite(db.Model):
-    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    character_id = db.Column(db.Integer, db.ForeignKey("character.id"))
+    character_id = db.Column(db.Integer, db.ForeignKey("character.id"), index=True)
     character = db.relationship("Character")
-    planet_id = db.Column(db.Integer, db.ForeignKey("planet.id"))
+    planet_id = db.Column(db.Integer, db.ForeignKey("planet.id"), index=True)
     planet = db.relationship("Planet")
-    vehicle_id = db.Column(db.Integer, db.ForeignKey("vehicle.id"))
+    vehicle_id = db.Column(db.Integer, db.ForeignKey("vehicle.id"), index=True)
     vehicle = db.relationship("Vehicle")
-
-    def serialize(self):
-        return {
-            "id": self.id,
-            "user_id": self.user_id,
-            "character_id": self.character_id,
-            "planet_id": self.planet_id,
-            "vehicle_id": self.vehicle_id,
-        }    
+    relations = {"character": "character", "planet": "planet", "vehicle": "vehicle"}
 
     #def __repr__(self):
     #    return '<User %r>' % self.username
@@ -0,0 +1,159 @@
+"""
+Popularity of characters, planets and vehicles: the denormalized `favorite_count`
+columns, kept up to date in the same transaction as every favorite insert/delete,
+and the top-N leaderboards served from memory for GET /leaderboard/<kind>.
+
+Favorites written through the ORM unit of work (add_favorite, the admin, a shell)
+are counted by a session event on flush; the writes that skip it (bulk inserts,
+query.delete()) call adjust_counts / discount_favorites themselves.
+
+If the counters ever drift (manual SQL, a restored backup) they can be checked and
+rebuilt from the favorite table:
+
+    $ pipenv run flask check-popularity
+    $ pipenv run flask rebuild-popularity
+"""
+import os
+import threading
+import time
+from collections import Counter
+import click
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, attributes
+from models import db, Character, Planet, Vehicle, Favorite
+from utils import APIException
+from cache import table_versions
+from collection import parse_int_arg
+from replicas import primary_reads
+
+KINDS = {"character": ("character_id", Character), "planet": ("planet_id", Planet), "vehicle": ("vehicle_id", Vehicle)}
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 100))
+
+def adjust_counts(favorites, delta, session=None):
+    """
+    Adds `delta` to the counter of every item referenced by `favorites` (Favorite
+    objects or mappings). One UPDATE per table and distinct amount, through Core so the
+    entity tables are not marked as changed: the counter is not part of their responses.
+    """
+    session = session or db.session
+    for column, model in KINDS.values():
+        counts = Counter()
+        for favorite in favorites:
+            target = favorite.get(column) if isinstance(favorite, dict) else getattr(favorite, column)
+            if target is not None:
+                counts[target] += delta
+        by_amount = {}
+        for target, amount in counts.items():
+            by_amount.setdefault(amount, []).append(target)
+        table = model.__table__
+        for amount, targets in by_amount.items():
+            session.execute(table.update().where(table.c.id.in_(targets))
+                            .values(favorite_count=table.c.favorite_count + amount))
+
+@event.listens_for(Session, "after_flush")
+def count_flushed_favorites(session, flush_context):
+    added = [obj for obj in session.new if isinstance(obj, Favorite)]
+    removed = [obj for obj in session.deleted if isinstance(obj, Favorite)]
+    for obj in session.dirty:
+        if not isinstance(obj, Favorite):
+            continue
+        # un favorito editado (p.ej. desde el admin) pasa de un item a otro
+        for column, model in KINDS.values():
+            history = attributes.get_history(obj, column)
+            if history.has_changes():
+                removed.extend({column: value} for value in history.deleted if value is not None)
+                added.extend({column: value} for value in history.added if value is not None)
+    if added:
+        adjust_counts(added, 1, session)
+    if removed:
+        adjust_counts(removed, -1, session)
+
+def discount_favorites(condition, skip=None):
+    """
+    Lowers the counters by the favorites matching `condition`, before they are deleted.
+    Everything happens in the database, one UPDATE per table, so no favorite is loaded;
+    the table of `skip` is left alone (its rows are being deleted too).
+    """
+    favorite = Favorite.__table__
+    for column, model in KINDS.values():
+        if model is skip:
+            continue
+        table = model.__table__
+        target = favorite.c[column]
+        removed = select([func.count(favorite.c.id)]).where(condition).where(target == table.c.id).as_scalar()
+        db.session.execute(table.update().where(table.c.id.in_(select([target]).where(condition)))
+                           .values(favorite_count=table.c.favorite_count - removed))
+
+def count_query(column, model):
+    return db.session.query(func.count(Favorite.id)).filter(getattr(Favorite, column) == model.id)
+
+def rebuild_counts():
+    """Recomputes every counter from the favorite table, one UPDATE per table."""
+    for column, model in KINDS.values():
+        table = model.__table__
+        db.session.execute(table.update().values(favorite_count=count_query(column, model).as_scalar()))
+    db.session.commit()
+
+def inconsistent_counts():
+    """{kind: [(id, stored, actual)]} for the counters that do not match the favorite table, {} if none."""
+    report = {}
+    for kind, (column, model) in KINDS.items():
+        actual = func.count(Favorite.id)
+        query = db.session.query(model.id, model.favorite_count, actual)
+        query = query.outerjoin(Favorite, getattr(Favorite, column) == model.id)
+        query = query.group_by(model.id, model.favorite_count).having(model.favorite_count != actual)
+        rows = [tuple(row) for row in query.order_by(model.id)]
+        if rows:
+            report[kind] = rows
+    return report
+
+boards = {}
+boards_lock = threading.Lock()
+
+def board_for(kind):
+    """
+    The top LEADERBOARD_SIZE items of `kind`, sorted by favorites, from the index on
+    favorite_count. Kept per worker and reloaded from the primary when the favorite or
+    entity table versions change, or after LEADERBOARD_TTL seconds.
+    """
+    column, model = KINDS[kind]
+    tables = ["favorite", model.__table__.name]
+    version = table_versions(tables)
+    ttl = int(os.environ.get('LEADERBOARD_TTL', 60))
+    entry = boards.get(kind)
+    if entry is None or entry[0] != version or time.monotonic() - entry[1] > ttl:
+        with boards_lock:
+            entry = boards.get(kind)
+            if entry is None or entry[0] != version or time.monotonic() - entry[1] > ttl:
+                with primary_reads(db.session):
+                    top = model.query.order_by(model.favorite_count.desc(), model.id).limit(LEADERBOARD_SIZE)
+                    entries = [dict(item.serialize(), favorite_count=item.favorite_count) for item in top]
+                entry = (version, time.monotonic(), entries)
+                boards[kind] = entry
+    return entry[2]
+
+def leaderboard(kind, args):
+    if kind not in KINDS:
+        raise APIException("'kind' must be one of: " + ", ".join(KINDS), status_code=404)
+    limit = parse_int_arg(args, "limit", 10)
+    if limit < 1 or limit > LEADERBOARD_SIZE:
+        raise APIException("'limit' must be between 1 and " + str(LEADERBOARD_SIZE), status_code=400)
+    return board_for(kind)[:limit]
+
+def setup_popularity(app):
+    @app.cli.command("rebuild-popularity")
+    def rebuild_popularity_command():
+        """Recompute the favorite counters from the favorite table."""
+        rebuild_counts()
+        click.echo("favorite counters rebuilt")
+
+    @app.cli.command("check-popularity")
+    def check_popularity_command():
+        """Compare the favorite counters with the favorite table."""
+        report = inconsistent_counts()
+        for kind, rows in report.items():
+            for item_id, stored, actual in rows:
+                click.echo(kind + " " + str(item_id) + ": counter " + str(stored) + ", favorites " + str(actual))
+        if report:
+            raise click.ClickException("favorite counters are out of date, run `flask rebuild-popularity`")
+        click.echo("favorite counters are consistent")
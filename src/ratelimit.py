@@ -0,0 +1,160 @@
+"""
+Admission control: a token bucket per client and a concurrency cap per expensive
+endpoint, so one client can't hold every worker.
+
+- Rate limit: every request takes a token from the bucket of its client: the
+  X-API-Key header when it is one of RATE_LIMIT_API_KEYS (comma separated), else
+  the client IP. Any other X-API-Key is ignored, so rotating made-up keys doesn't
+  give new buckets. With RATE_LIMIT_TRUST_PROXY=true, as behind the Heroku router,
+  the IP is the last X-Forwarded-For hop, the one the router appends; the hops
+  before it come from the client and can be anything. Buckets refill at
+  RATE_LIMIT_RATE tokens per second up to RATE_LIMIT_BURST; an empty bucket is
+  answered with a 429 and Retry-After. RATE_LIMIT_RATE=0 (the default) turns it off.
+  Buckets live in this process (RATE_LIMIT_BACKEND=memory) or in redis (redis),
+  shared by every worker and host.
+- Concurrency cap: `@limit_concurrency()` lets at most EXPENSIVE_MAX_CONCURRENT
+  requests per process run the wrapped view at once; the rest get a 503 with
+  Retry-After instead of queueing behind them. Put it under @cached so cache hits
+  never count. The default is one less than the threads of a worker (at least 1),
+  so an expensive endpoint never takes every thread: with threaded workers
+  (GUNICORN_CMD_ARGS="--threads 4") it is 3. Sync workers serve one request at a
+  time, so there the cap never sheds anything; a value at or above the threads per
+  worker doesn't either.
+
+/health/db and /metrics are never limited. Counters are exported on /metrics.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, jsonify, request
+from utils import web_threads
+
+EXEMPT_PATHS = ("/health/db", "/metrics")
+
+class MemoryBuckets:
+    # un cubo por cliente en este proceso, los menos usados se olvidan pasado max_clients
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """Takes a token; returns 0 if allowed, else the seconds until one is available."""
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return wait
+
+# el mismo algoritmo que MemoryBuckets.take, atomico dentro de redis
+TAKE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisBuckets:
+    """
+    Works with any client exposing the redis-py `eval` method. The tests run it on
+    the dict-backed fake of tests/fakes.py and, when installed, on fakeredis, which
+    runs the Lua script.
+    """
+    def __init__(self, client, prefix="swapi:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, now):
+        return float(self.client.eval(TAKE_SCRIPT, 1, self.prefix + key, rate, burst, now))
+
+buckets = MemoryBuckets()
+stats = {"allowed": 0, "limited": 0, "shed": {}}
+stats_lock = threading.Lock()
+
+def api_keys():
+    return set(key.strip() for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key.strip())
+
+def client_key():
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in api_keys():
+        return "key:" + api_key
+    if os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() in ('1', 'true', 'yes'):
+        # el router agrega la IP que ve al final; los saltos anteriores los manda el cliente
+        return "ip:" + (request.access_route[-1] if request.access_route else "")
+    return "ip:" + (request.remote_addr or "")
+
+def rejection(status_code, message, retry_after):
+    response = jsonify({"message": message})
+    response.status_code = status_code
+    response.headers["Retry-After"] = str(max(1, int(math.ceil(retry_after))))
+    return response
+
+def check_rate_limit():
+    rate = float(os.environ.get('RATE_LIMIT_RATE', 0))
+    if rate <= 0 or request.path in EXEMPT_PATHS:
+        return None
+    burst = float(os.environ.get('RATE_LIMIT_BURST', max(1.0, rate * 2)))
+    wait = buckets.take(client_key(), rate, burst, time.time())
+    with stats_lock:
+        stats["allowed" if wait == 0 else "limited"] += 1
+    if wait > 0:
+        return rejection(429, "Too many requests, slow down", wait)
+    return None
+
+def default_max_concurrent():
+    value = os.environ.get('EXPENSIVE_MAX_CONCURRENT')
+    return int(value) if value else max(1, web_threads() - 1)
+
+def limit_concurrency(max_concurrent=None):
+    """Sheds the requests over `max_concurrent` (default EXPENSIVE_MAX_CONCURRENT) running the view."""
+    def decorator(view):
+        slots = threading.BoundedSemaphore(max_concurrent or default_max_concurrent())
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not slots.acquire(blocking=False):
+                with stats_lock:
+                    stats["shed"][request.endpoint] = stats["shed"].get(request.endpoint, 0) + 1
+                return rejection(503, "The server is busy, try again later", 1)
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except Exception:
+                slots.release()
+                raise
+            if response.is_streamed:
+                # el trabajo de una respuesta en streaming se hace mientras se envia
+                response.call_on_close(slots.release)
+            else:
+                slots.release()
+            return response
+        return wrapper
+    return decorator
+
+def get_stats():
+    with stats_lock:
+        return {"allowed": stats["allowed"], "limited": stats["limited"], "shed": dict(stats["shed"])}
+
+def setup_rate_limit(app):
+    global buckets
+    if os.environ.get('RATE_LIMIT_BACKEND', 'memory') == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package: pipenv install redis")
+        buckets = RedisBuckets(redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0')))
+    else:
+        buckets = MemoryBuckets(max_clients=int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000)))
+    app.before_request(check_rate_limit)
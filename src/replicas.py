@@ -0,0 +1,127 @@
+"""
+Optional read-replica routing.
+
+When DB_REPLICA_CONNECTION_STRINGS has one or more connection strings (comma
+separated), queries issued while serving a GET/HEAD request go to a replica,
+round robin between requests: every query of one request reads from the same one.
+Everything else uses the primary (DB_CONNECTION_STRING):
+- writes, and any read in a request after it has flushed a write (read-after-write)
+- cached GETs reading a table written less than DB_REPLICA_LAG_WINDOW seconds ago
+  (see `read_after_write`), so a lagging replica never fills the cache or the ETags
+  of the new table versions with the old rows
+- the reloads of the per-worker copies (snapshot, search index, leaderboard), see
+  `primary_reads`
+- code running outside a request (CLI, migrations, shell)
+- all requests while every replica is failing its health check
+
+Replicas are pinged at most every DB_REPLICA_CHECK_INTERVAL seconds; a failing
+one is skipped until it answers again. Two SQLite files are enough to try it locally.
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+
+READ_METHODS = ("GET", "HEAD")
+
+class Replica:
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = 0.0
+        self.error = None
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replicas = []
+        self.check_interval = 30
+        self.lag_window = 5
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def configure(self, urls, engine_options, check_interval=30, lag_window=5):
+        """`engine_options` maps each url to its create_engine keyword arguments."""
+        self.replicas = [Replica(url, create_engine(url, **engine_options[url])) for url in urls]
+        self.check_interval = check_interval
+        self.lag_window = lag_window
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            replica.healthy, replica.error = True, None
+        except SQLAlchemyError as exception:
+            replica.healthy, replica.error = False, str(exception.__class__.__name__) + ": " + str(exception)
+        replica.checked_at = time.monotonic()
+
+    def pick(self):
+        """Next healthy replica engine, or None to fall back to the primary."""
+        if not self.replicas:
+            return None
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self.counter) % len(self.replicas)]
+            if now - replica.checked_at > self.check_interval:
+                with self.lock:
+                    if now - replica.checked_at > self.check_interval:
+                        self.check(replica)
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def dispose(self):
+        """Closes the pooled connections, e.g. before gunicorn forks the workers."""
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def status(self):
+        return [{"url": repr(replica.engine.url), "healthy": replica.healthy, "error": replica.error}
+                for replica in self.replicas]
+
+router = ReplicaRouter()
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if (router.replicas and not self._flushing and not self.info.get("pinned_primary")
+                and has_request_context() and request.method in READ_METHODS):
+            # la replica se elige una vez por sesion (por peticion): si cada query fuera a una
+            # distinta, las selectinload podrian leer de una replica mas atrasada que la primera
+            if "replica" not in self.info:
+                self.info["replica"] = router.pick()
+            if self.info["replica"] is not None:
+                return self.info["replica"]
+        return super().get_bind(mapper, clause)
+
+@event.listens_for(RoutingSession, "after_flush")
+def pin_primary(session, flush_context):
+    # despues de escribir, el resto de la peticion lee del primario para ver sus propios cambios
+    session.info["pinned_primary"] = True
+
+def read_after_write(session, written_at):
+    """
+    Pins `session` to the primary when the tables about to be read were last written
+    (`written_at`, a time.time() or None) less than DB_REPLICA_LAG_WINDOW seconds ago.
+    """
+    if router.replicas and written_at is not None and time.time() - written_at < router.lag_window:
+        session.info["pinned_primary"] = True
+
+@contextmanager
+def primary_reads(session):
+    """Sends the reads of the block to the primary, whatever the request picked."""
+    pinned = session.info.get("pinned_primary")
+    session.info["pinned_primary"] = True
+    try:
+        yield session
+    finally:
+        if not pinned:
+            session.info.pop("pinned_primary", None)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,274 @@
+"""
+Name search over characters, planets and vehicles for GET /search.
+
+- mode=prefix (default): every word of the query must start a word of the name.
+  On MySQL it uses the FULLTEXT indexes on `name`, unless a word is shorter than
+  SEARCH_FULLTEXT_MIN_WORD (innodb_ft_min_token_size, 3 by default), which FULLTEXT
+  never matches; then, and on other databases, an in-process prefix index (sorted
+  word list searched with bisect, like a trie) is used.
+- mode=fuzzy: trigram similarity, tolerant to typos, from an in-process n-gram index.
+
+In-process indexes are built per worker from (id, name) rows. Names created, renamed
+or deleted through the ORM (and the deletes of bulk.py) are patched into the index
+when the transaction commits, like snapshot.py does with its rows. Any other change
+of the table version (bulk inserts, other workers with a shared cache backend) or
+SEARCH_INDEX_TTL seconds since the last load rebuild it in a background thread,
+while searches keep using the current one: only the first search of a kind waits
+for a build. Lookups only touch the matching words/trigrams, so they stay flat as
+the tables grow.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Character, Planet, Vehicle
+from utils import APIException
+from cache import table_versions, skip_cache
+from collection import parse_int_arg
+from replicas import primary_reads
+
+KINDS = {"character": Character, "planet": Planet, "vehicle": Vehicle}
+TABLE_KINDS = {model.__table__.name: kind for kind, model in KINDS.items()}
+MAX_LIMIT = 100
+MIN_FUZZY_SCORE = 0.3
+WORD = re.compile(r"\w+", re.UNICODE)
+logger = logging.getLogger("search")
+
+def words(text):
+    return WORD.findall(text.lower())
+
+def trigrams(text):
+    padded = "  " + text.lower() + " "
+    return set(padded[position:position + 3] for position in range(len(padded) - 2))
+
+class NameIndex:
+    """
+    Prefix and trigram index over the names of one model at table `version`. Patched
+    in place under its own lock, which every lookup also takes.
+    """
+    def __init__(self, rows, version):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.names = {}
+        self.words = []
+        self.grams = {}
+        for object_id, name in rows:
+            self.names[object_id] = name
+            for word in set(words(name)):
+                self.words.append((word, object_id))
+            for gram in trigrams(name):
+                self.grams.setdefault(gram, []).append(object_id)
+        self.words.sort()
+
+    def add(self, object_id, name):
+        self.names[object_id] = name
+        for word in set(words(name)):
+            insort(self.words, (word, object_id))
+        for gram in trigrams(name):
+            self.grams.setdefault(gram, []).append(object_id)
+
+    def remove(self, object_id):
+        name = self.names.pop(object_id, None)
+        if name is None:
+            return
+        for word in set(words(name)):
+            position = bisect_left(self.words, (word, object_id))
+            if position < len(self.words) and self.words[position] == (word, object_id):
+                del self.words[position]
+        for gram in trigrams(name):
+            self.grams[gram].remove(object_id)
+
+    def patch(self, changes, version):
+        """Applies {id: name or None for deleted} and moves the index to `version`."""
+        with self.lock:
+            for object_id, name in changes.items():
+                self.remove(object_id)
+                if name is not None:
+                    self.add(object_id, name)
+            self.version = version
+
+    def ids_with_prefix(self, prefix):
+        matches = set()
+        position = bisect_left(self.words, (prefix,))
+        while position < len(self.words) and self.words[position][0].startswith(prefix):
+            matches.add(self.words[position][1])
+            position += 1
+        return matches
+
+    def prefix(self, query_words):
+        """(score, id, name) for the names where every query word starts a word."""
+        with self.lock:
+            matches = None
+            for word in query_words:
+                found = self.ids_with_prefix(word)
+                matches = found if matches is None else matches & found
+                if not matches:
+                    return []
+            phrase = " ".join(query_words)
+            results = []
+            for object_id in matches:
+                name = self.names[object_id].lower()
+                # nombre exacto > empieza por la busqueda > contiene las palabras; los cortos primero
+                score = 3.0 if name == phrase else 2.0 if name.startswith(phrase) else 1.0
+                results.append((score + 1.0 / (1 + len(name)), object_id, self.names[object_id]))
+            return results
+
+    def fuzzy(self, query):
+        query_grams = trigrams(query)
+        with self.lock:
+            shared = {}
+            for gram in query_grams:
+                for object_id in self.grams.get(gram, ()):
+                    shared[object_id] = shared.get(object_id, 0) + 1
+            results = []
+            for object_id, count in shared.items():
+                # coeficiente de Dice entre los trigramas de la busqueda y los del nombre
+                score = 2.0 * count / (len(query_grams) + len(trigrams(self.names[object_id])))
+                if score >= MIN_FUZZY_SCORE:
+                    results.append((score, object_id, self.names[object_id]))
+            return results
+
+indexes = {}
+# un lock por tipo: la primera carga de uno no bloquea las busquedas de los otros
+build_locks = {kind: threading.Lock() for kind in KINDS}
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+def load_index(kind):
+    model = KINDS[kind]
+    # la version se lee antes que las filas: el indice nunca es mas viejo que su version
+    version = table_versions([model.__table__.name])[model.__table__.name]
+    with primary_reads(db.session):
+        rows = db.session.query(model.id, model.name).yield_per(10000)
+        return NameIndex(rows, version)
+
+def refresh(app, kind):
+    try:
+        with app.app_context():
+            try:
+                index = load_index(kind)
+            finally:
+                db.session.remove()
+        current = indexes.get(kind)
+        # un commit pudo parchear el indice actual mientras se cargaba este
+        if current is None or index.version >= current.version:
+            indexes[kind] = index
+    except Exception:
+        logger.exception("rebuilding the %s search index failed", kind)
+    finally:
+        with refreshing_lock:
+            refreshing.discard(kind)
+
+def refresh_in_background(kind):
+    with refreshing_lock:
+        if kind in refreshing:
+            return
+        refreshing.add(kind)
+    threading.Thread(target=refresh, args=(current_app._get_current_object(), kind), daemon=True).start()
+
+def index_for(kind):
+    index = indexes.get(kind)
+    if index is None:
+        with build_locks[kind]:
+            index = indexes.get(kind)
+            if index is None:
+                index = indexes[kind] = load_index(kind)
+        return index
+    table = KINDS[kind].__table__.name
+    ttl = int(os.environ.get('SEARCH_INDEX_TTL', 300))
+    version = table_versions([table])[table]
+    if index.version != version:
+        # el indice aun no tiene la version actual: su resultado no se cachea con ella
+        skip_cache()
+    if index.version != version or time.monotonic() - index.loaded_at > ttl:
+        refresh_in_background(kind)
+    return index
+
+# Cambios de nombres hechos con el ORM: se aplican al indice al confirmar la transaccion
+
+@event.listens_for(Session, "after_flush")
+def collect_name_changes(session, flush_context):
+    changes = session.info.setdefault("search_changes", {})
+    for obj in list(session.new) + list(session.dirty):
+        kind = TABLE_KINDS.get(type(obj).__table__.name)
+        if kind in indexes:
+            changes.setdefault(kind, {})[obj.id] = obj.name
+    for obj in session.deleted:
+        kind = TABLE_KINDS.get(type(obj).__table__.name)
+        if kind in indexes:
+            changes.setdefault(kind, {})[obj.id] = None
+
+def unindex(session, model, ids):
+    """For query.delete() on `ids`, so the index drops them instead of being rebuilt."""
+    kind = TABLE_KINDS.get(model.__table__.name)
+    if kind in indexes:
+        session.info.setdefault("search_changes", {}).setdefault(kind, {}).update((object_id, None) for object_id in ids)
+
+@event.listens_for(Session, "after_commit")
+def apply_name_changes(session):
+    changes = session.info.pop("search_changes", {})
+    if not changes:
+        return
+    versions = table_versions([KINDS[kind].__table__.name for kind in changes])
+    for kind, kind_changes in changes.items():
+        index = indexes.get(kind)
+        # solo se parchea si este commit es el unico cambio desde la ultima carga
+        if index is not None and versions[KINDS[kind].__table__.name] == index.version + 1:
+            index.patch(kind_changes, index.version + 1)
+
+@event.listens_for(Session, "after_rollback")
+def forget_name_changes(session):
+    session.info.pop("search_changes", None)
+
+def fulltext_prefix(model, query_words, limit):
+    """MySQL FULLTEXT boolean search, every word as a required prefix."""
+    expression = " ".join("+" + word + "*" for word in query_words)
+    score = model.name.match(expression)
+    rows = db.session.query(model.id, model.name, score).filter(score).order_by(score.desc(), model.id).limit(limit)
+    return [(float(relevance), object_id, name) for object_id, name, relevance in rows]
+
+def search(args):
+    query = (args.get("q") or "").strip()
+    if not query:
+        raise APIException("You need to specify the search with ?q=", status_code=400)
+    mode = args.get("mode", "prefix")
+    if mode not in ("prefix", "fuzzy"):
+        raise APIException("'mode' must be prefix or fuzzy", status_code=400)
+    kinds = [args.get("kind")] if args.get("kind") else list(KINDS)
+    if any(kind not in KINDS for kind in kinds):
+        raise APIException("'kind' must be one of: " + ", ".join(KINDS), status_code=400)
+    limit = parse_int_arg(args, "limit", 20)
+    offset = parse_int_arg(args, "offset", 0)
+    if limit < 1 or limit > MAX_LIMIT or offset < 0:
+        raise APIException("'limit' must be between 1 and " + str(MAX_LIMIT) + " and 'offset' positive", status_code=400)
+
+    query_words = words(query)
+    # FULLTEXT no indexa las palabras cortas: con ellas no devolveria nada
+    min_word = int(os.environ.get('SEARCH_FULLTEXT_MIN_WORD', 3))
+    use_fulltext = (mode == "prefix" and db.engine.dialect.name == "mysql"
+                    and all(len(word) >= min_word for word in query_words))
+    results = []
+    for kind in kinds:
+        if not query_words and mode == "prefix":
+            break
+        if use_fulltext:
+            matches = fulltext_prefix(KINDS[kind], query_words, offset + limit + 1)
+        elif mode == "prefix":
+            matches = index_for(kind).prefix(query_words)
+        else:
+            matches = index_for(kind).fuzzy(query)
+        results.extend((score, kind, object_id, name) for score, object_id, name in matches)
+
+    results.sort(key=lambda result: (-result[0], result[1], result[2]))
+    page = results[offset:offset + limit]
+    return {
+        "response": [{"kind": kind, "id": object_id, "name": name, "score": round(score, 4)}
+                     for score, kind, object_id, name in page],
+        "next": offset + limit if len(results) > offset + limit else None,
+    }
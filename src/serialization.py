@@ -0,0 +1,52 @@
+"""
+Fast serialization helpers.
+
+- column_serializer(model): a function built once per model from its mapped columns
+  that turns an instance (or a row tuple with the same names) into a dict.
+- FastJSONEncoder: the app's JSON encoder. It encodes with orjson when the package is
+  installed (`pipenv install orjson`) and falls back to the stdlib json module
+  otherwise. JSON_BACKEND=stdlib forces the fallback.
+"""
+import os
+from operator import attrgetter
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_backend():
+    if orjson is not None and os.environ.get('JSON_BACKEND', 'auto') != 'stdlib':
+        return "orjson"
+    return "stdlib"
+
+def public_columns(model):
+    hidden = getattr(model, "hidden_fields", ())
+    return {column.name: column for column in model.__table__.columns if column.name not in hidden}
+
+serializers = {}
+
+def column_serializer(model):
+    serializer = serializers.get(model)
+    if serializer is None:
+        names = tuple(public_columns(model))
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            serializer = lambda obj: {names[0]: getter(obj)}
+        else:
+            serializer = lambda obj: dict(zip(names, getter(obj)))
+        serializers[model] = serializer
+    return serializer
+
+class FastJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        if json_backend() != "orjson":
+            return super().encode(o)
+        # las fechas pasan por default() para mantener el formato de Flask
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode()
@@ -0,0 +1,201 @@
+"""
+Opt-in in-memory snapshot of the reference tables (SNAPSHOT_TABLES=true):
+characters, planets and vehicles are loaded when the app is created, so every
+gunicorn worker starts warm (or, with `gunicorn --preload`, the master loads them
+once and the workers share the pages copy-on-write), and every row is kept as
+its already encoded JSON bytes.
+
+GET /<kind>/<id> and the plain pages of GET /<kind> (only ?limit= and ?cursor=, or
+?ids=) are answered by joining those bytes, without touching the database or the
+JSON encoder. Anything else (filters, fields, include, streams) still goes to
+collection.py.
+
+Rows created, updated or deleted through the ORM are patched into the snapshot
+when the transaction commits. Bulk writes, writes from other workers or more than
+SNAPSHOT_TTL seconds since the last load make the next read reload the table.
+Other workers are only seen through the table versions of cache.py when they are
+shared (CACHE_BACKEND=redis), so with several workers (WEB_CONCURRENCY > 1) the
+snapshot refuses to start on the memory backend. Writes made outside the app
+(plain SQL) show up after SNAPSHOT_TTL.
+"""
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from flask import Response, json
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Character, Planet, Vehicle
+from utils import APIException, env_flag
+import cache
+from cache import table_versions
+from collection import DEFAULT_LIMIT, MAX_LIMIT, parse_int_arg, parse_ids
+from serialization import public_columns
+from replicas import router, primary_reads
+
+MODELS = {model.__table__.name: model for model in (Character, Planet, Vehicle)}
+logger = logging.getLogger("snapshot")
+
+def encode(row):
+    return json.dumps(row, separators=(",", ":")).encode("utf-8")
+
+class TableSnapshot:
+    """Sorted ids and encoded rows of one table; replaced as a whole, never mutated."""
+    def __init__(self, ids, rows, version):
+        self.ids = ids
+        self.rows = rows
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def patched(self, changes, version):
+        rows = dict(self.rows)
+        for object_id, body in changes.items():
+            if body is None:
+                rows.pop(object_id, None)
+            else:
+                rows[object_id] = body
+        snapshot = TableSnapshot(array("q", sorted(rows)), rows, version)
+        snapshot.loaded_at = self.loaded_at
+        return snapshot
+
+snapshots = {}
+snapshots_lock = threading.Lock()
+enabled = False
+
+def load(model):
+    table = model.__table__.name
+    version = table_versions([table])[table]
+    names = list(public_columns(model))
+    rows = {}
+    with primary_reads(db.session):
+        for row in db.session.query(*[getattr(model, name) for name in names]).yield_per(1000):
+            rows[row.id] = encode(dict(zip(names, row)))
+    snapshots[table] = TableSnapshot(array("q", sorted(rows)), rows, version)
+    return snapshots[table]
+
+def current(model):
+    """The up to date snapshot of `model`, or None when snapshots are off."""
+    if not enabled:
+        return None
+    table = model.__table__.name
+    version = table_versions([table])[table]
+    ttl = int(os.environ.get('SNAPSHOT_TTL', 300))
+    snapshot = snapshots.get(table)
+    if snapshot is None or snapshot.version != version or time.monotonic() - snapshot.loaded_at > ttl:
+        with snapshots_lock:
+            snapshot = snapshots.get(table)
+            if snapshot is None or snapshot.version != version or time.monotonic() - snapshot.loaded_at > ttl:
+                snapshot = load(model)
+    return snapshot
+
+def json_response(*parts):
+    return Response(b"".join(parts) + b"\n", mimetype="application/json")
+
+def snapshot_one(model, object_id):
+    """GET one from the snapshot; None when snapshots are off."""
+    snapshot = current(model)
+    if snapshot is None:
+        return None
+    body = snapshot.rows.get(object_id)
+    if body is None:
+        raise APIException(model.__name__ + " not found", status_code=404)
+    return json_response(b'{"response":', body, b"}")
+
+def snapshot_collection(model, request):
+    """
+    A page (?limit=, ?cursor=) or a batch (?ids=) from the snapshot, in the same format
+    as collection.py; None when snapshots are off or the arguments need the database.
+    """
+    args = request.args
+    if any(name not in ("limit", "cursor", "ids") for name in args) or "application/x-ndjson" in request.headers.get("Accept", ""):
+        return None
+    snapshot = current(model)
+    if snapshot is None:
+        return None
+    if args.get("ids"):
+        if len(args) > 1:
+            return None
+        ids = parse_ids(args)
+        found = [snapshot.rows[object_id] for object_id in ids if object_id in snapshot.rows]
+        missing = [object_id for object_id in ids if object_id not in snapshot.rows]
+        return json_response(b'{"missing":', encode(missing), b',"response":[', b",".join(found), b"]}")
+
+    limit = parse_int_arg(args, "limit", DEFAULT_LIMIT)
+    if limit < 1 or limit > MAX_LIMIT:
+        raise APIException("'limit' must be between 1 and " + str(MAX_LIMIT), status_code=400)
+    cursor = parse_int_arg(args, "cursor")
+    start = 0 if cursor is None else bisect_right(snapshot.ids, cursor)
+    page = snapshot.ids[start:start + limit]
+    next_cursor = page[-1] if len(snapshot.ids) > start + limit else None
+    return json_response(b'{"next":', encode(next_cursor), b',"response":[',
+                         b",".join(snapshot.rows[object_id] for object_id in page), b"]}")
+
+@event.listens_for(Session, "after_flush")
+def collect_snapshot_changes(session, flush_context):
+    if not enabled:
+        return
+    changes = session.info.setdefault("snapshot_changes", {})
+    for obj in list(session.new) + list(session.dirty):
+        if type(obj).__table__.name in MODELS and type(obj).__table__.name in snapshots:
+            changes.setdefault(type(obj).__table__.name, {})[obj.id] = encode(obj.serialize())
+    for obj in session.deleted:
+        if type(obj).__table__.name in MODELS:
+            changes.setdefault(type(obj).__table__.name, {})[obj.id] = None
+
+def mark_deleted(session, model, ids):
+    """For query.delete() on `ids`, so the snapshot drops them instead of reloading the table."""
+    if enabled and model.__table__.name in MODELS:
+        changes = session.info.setdefault("snapshot_changes", {}).setdefault(model.__table__.name, {})
+        changes.update((object_id, None) for object_id in ids)
+
+@event.listens_for(Session, "after_bulk_delete")
+@event.listens_for(Session, "after_bulk_update")
+def collect_snapshot_bulk_changes(update_context):
+    table = update_context.mapper.local_table.name
+    # un delete ya anotado con mark_deleted no hace falta recargarlo
+    if enabled and table in MODELS and table not in update_context.session.info.get("snapshot_changes", {}):
+        update_context.session.info.setdefault("snapshot_stale", set()).add(table)
+
+@event.listens_for(Session, "after_commit")
+def apply_snapshot_changes(session):
+    changes = session.info.pop("snapshot_changes", {})
+    stale = session.info.pop("snapshot_stale", set())
+    if not changes:
+        return
+    tables = [table for table in changes if table not in stale and table in snapshots]
+    versions = table_versions(tables) if tables else {}
+    with snapshots_lock:
+        for table in tables:
+            snapshot = snapshots.get(table)
+            # solo se parchea si este commit es el unico cambio desde la ultima carga
+            if snapshot is not None and versions[table] == snapshot.version + 1:
+                snapshots[table] = snapshot.patched(changes[table], versions[table])
+
+@event.listens_for(Session, "after_rollback")
+def forget_snapshot_changes(session):
+    session.info.pop("snapshot_changes", None)
+    session.info.pop("snapshot_stale", None)
+
+def setup_snapshot(app):
+    global enabled
+    enabled = env_flag('SNAPSHOT_TABLES', False)
+    if not enabled:
+        return
+    if not cache.backend.shared and int(os.environ.get('WEB_CONCURRENCY') or 1) > 1:
+        raise RuntimeError("SNAPSHOT_TABLES=true with several workers needs CACHE_BACKEND=redis, "
+                           "the memory backend does not see the writes of the other workers")
+    if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        return
+    try:
+        with app.app_context():
+            for model in MODELS.values():
+                load(model)
+            db.session.remove()
+            # con --preload esto corre en el master: los workers no deben heredar sus conexiones
+            db.engine.dispose()
+            router.dispose()
+    except Exception:
+        # p.ej. la base de datos aun no esta migrada: se cargan con la primera peticion
+        logger.exception("could not preload the snapshot, it will be loaded on the first request")
@@ -0,0 +1,261 @@
+"""
+Export and import of the whole dataset as NDJSON or CSV files, one per table, for
+backups and moves between databases without a raw dump:
+
+    $ pipenv run export-data backup/ --format csv --jobs 4
+    $ pipenv run import-data backup/
+
+Both directions keep constant memory: the export reads every table through a
+server-side cursor in batches of --chunk-size rows and writes them as they come, the
+import reads the files line by line and inserts each chunk with `bulk_insert_mappings`,
+one commit per chunk. Rows keep their ids, so import into empty tables; on PostgreSQL
+the id sequences are moved past the imported ids.
+
+The export is a consistent snapshot even while the app keeps writing: every table
+is read inside one REPEATABLE READ transaction, so a favorite never points to a user
+or item written after that table was exported (which would make the import fail on
+its foreign keys halfway). On MySQL and SQLite that means one connection reading the
+tables one after the other, and --jobs is ignored. On PostgreSQL, --jobs connections
+read tables in parallel, all from the snapshot exported by the first one
+(pg_export_snapshot). The import runs --jobs tables in parallel, level by level so
+every foreign key points to rows that are already there.
+
+The favorite counters are not exported: the import recomputes them from the favorite
+table at the end. In CSV files an empty cell is NULL when the column allows it.
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from sqlalchemy import func, select, text
+from models import db, User, Character, Planet, Vehicle, Favorite
+from cache import mark_changed
+from popularity import rebuild_counts
+
+MODELS = {model.__table__.name: model for model in (User, Character, Planet, Vehicle, Favorite)}
+FORMATS = ("ndjson", "csv")
+PROGRESS_EVERY = 100000
+
+def exported_columns(model):
+    counters = getattr(model, "counter_fields", ())
+    return [column for column in model.__table__.columns if column.name not in counters]
+
+def levels(tables):
+    """Groups `tables` so each group only references tables of earlier groups."""
+    pending, done, groups = list(tables), set(), []
+    while pending:
+        group = [table for table in pending
+                 if all(key.column.table.name in done or key.column.table.name not in pending
+                        for key in MODELS[table].__table__.foreign_keys if key.column.table.name != table)]
+        if not group:
+            raise click.ClickException("circular foreign keys between " + ", ".join(pending))
+        groups.append(group)
+        done.update(group)
+        pending = [table for table in pending if table not in group]
+    return groups
+
+class Progress:
+    """Rows done for one table, echoed every PROGRESS_EVERY rows and at the end with rows/second."""
+    def __init__(self, action, table):
+        self.action = action
+        self.table = table
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def add(self, rows):
+        before = self.rows
+        self.rows += rows
+        if self.rows // PROGRESS_EVERY > before // PROGRESS_EVERY:
+            click.echo(self.table + ": " + str(self.rows) + " rows " + self.action + " so far")
+
+    def report(self):
+        seconds = time.monotonic() - self.started
+        click.echo("%s: %d rows %s in %.2fs (%.0f rows/s)" % (self.table, self.rows, self.action, seconds,
+                                                              self.rows / seconds if seconds else 0))
+        return self
+
+def export_table(connection, table, directory, file_format, chunk_size):
+    model = MODELS[table]
+    columns = exported_columns(model)
+    names = [column.name for column in columns]
+    progress = Progress("exported", table)
+    path = os.path.join(directory, table + "." + file_format)
+    with open(path, "w", newline="", encoding="utf-8") as output:
+        writer = csv.writer(output) if file_format == "csv" else None
+        if writer:
+            writer.writerow(names)
+        # stream_results: cursor del lado del servidor, las filas llegan por bloques
+        result = connection.execution_options(stream_results=True).execute(
+            select(columns).order_by(model.__table__.c.id))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(["" if value is None else value for value in row] for row in rows)
+            else:
+                output.writelines(json.dumps(dict(zip(names, row)), separators=(",", ":")) + "\n" for row in rows)
+            progress.add(len(rows))
+        result.close()
+    return progress.report()
+
+def snapshot_connection(engine):
+    """A connection whose transaction reads every table from the same snapshot."""
+    if engine.dialect.name == "sqlite":
+        connection = engine.connect()
+        transaction = connection.begin()
+        # pysqlite no abre la transaccion antes de un SELECT: sin BEGIN cada tabla se leeria por separado
+        connection.execute(text("BEGIN"))
+        return connection, transaction
+    connection = engine.connect().execution_options(isolation_level="REPEATABLE READ")
+    transaction = connection.begin()
+    if engine.dialect.name == "mysql":
+        connection.execute(text("START TRANSACTION WITH CONSISTENT SNAPSHOT"))
+    return connection, transaction
+
+def export_tables(engine, tables, directory, file_format, chunk_size, jobs):
+    connection, transaction = snapshot_connection(engine)
+    try:
+        if engine.dialect.name != "postgresql" or jobs <= 1 or len(tables) <= 1:
+            if jobs > 1:
+                click.echo("exporting in one transaction, --jobs only applies to PostgreSQL")
+            return [export_table(connection, table, directory, file_format, chunk_size) for table in tables]
+        snapshot = connection.execute(text("SELECT pg_export_snapshot()")).scalar()
+
+        def export_from_snapshot(table):
+            with engine.connect().execution_options(isolation_level="REPEATABLE READ") as worker:
+                with worker.begin():
+                    # tiene que ser la primera sentencia de la transaccion
+                    worker.execute(text("SET TRANSACTION SNAPSHOT '" + snapshot + "'"))
+                    return export_table(worker, table, directory, file_format, chunk_size)
+        # la transaccion que exporto el snapshot sigue abierta hasta que terminan todas
+        return run_parallel(jobs, tables, export_from_snapshot)
+    finally:
+        transaction.rollback()
+        connection.close()
+
+def read_file(path, model):
+    """Yields (line, row) from an NDJSON or CSV file, converting CSV cells to the column types."""
+    columns = {column.name: column for column in exported_columns(model)}
+    with open(path, newline="", encoding="utf-8") as source:
+        if path.endswith(".ndjson"):
+            for line, text_line in enumerate(source, 1):
+                if text_line.strip():
+                    try:
+                        yield line, json.loads(text_line)
+                    except ValueError:
+                        raise click.ClickException(path + " line " + str(line) + ": invalid JSON")
+            return
+        reader = csv.DictReader(source)
+        unknown = [name for name in reader.fieldnames or () if name not in columns]
+        if unknown:
+            raise click.ClickException(path + ": unknown columns " + ", ".join(unknown))
+        for row in reader:
+            converted = {}
+            for name, value in row.items():
+                column = columns[name]
+                if value == "" and (column.nullable or column.type.python_type is not str):
+                    converted[name] = None
+                elif column.type.python_type is int:
+                    try:
+                        converted[name] = int(value)
+                    except ValueError:
+                        raise click.ClickException(path + " line " + str(reader.line_num) + ": '" + name + "' must be an integer")
+                else:
+                    converted[name] = value
+            yield reader.line_num, converted
+
+def insert_rows(model, rows):
+    db.session.bulk_insert_mappings(model, rows)
+    mark_changed(db.session, model.__table__.name)
+    db.session.commit()
+
+def import_table(app, table, path, chunk_size):
+    model = MODELS[table]
+    progress = Progress("imported", table)
+    with app.app_context():
+        chunk, first_line = [], None
+        try:
+            for line, row in read_file(path, model):
+                if not chunk:
+                    first_line = line
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    insert_rows(model, chunk)
+                    progress.add(len(chunk))
+                    chunk = []
+            if chunk:
+                insert_rows(model, chunk)
+                progress.add(len(chunk))
+        except click.ClickException:
+            db.session.rollback()
+            raise
+        except Exception as error:
+            db.session.rollback()
+            raise click.ClickException(path + " from line " + str(first_line) + ": " + str(getattr(error, "orig", error)) +
+                                       " (" + str(progress.rows) + " rows were already imported)")
+        if db.engine.dialect.name == "postgresql":
+            # los ids se insertaron a mano, la secuencia tiene que seguir despues del mayor
+            quoted = db.engine.dialect.identifier_preparer.quote(table)
+            db.session.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :value)"),
+                               {"table": quoted, "value": db.session.query(func.max(model.id)).scalar() or 1})
+            db.session.commit()
+    return progress.report()
+
+def run_parallel(jobs, tables, task):
+    """Runs task(table) for every table, `jobs` at a time; each task opens its own connection or session."""
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return list(executor.map(task, tables))
+
+def report_total(action, results, started):
+    rows = sum(progress.rows for progress in results)
+    seconds = time.monotonic() - started
+    click.echo("%d rows %s in %.2fs (%.0f rows/s)" % (rows, action, seconds, rows / seconds if seconds else 0))
+
+def setup_transfer(app):
+    table_option = click.option("--table", "tables", multiple=True, type=click.Choice(list(MODELS)),
+                                help="Only these tables (repeat the option), default all.")
+    chunk_option = click.option("--chunk-size", default=5000, show_default=True, help="Rows per batch.")
+    jobs_option = click.option("--jobs", default=4, show_default=True,
+                               help="Tables processed in parallel (the export only on PostgreSQL).")
+
+    @app.cli.command("export-data")
+    @click.argument("directory", type=click.Path(file_okay=False))
+    @click.option("--format", "file_format", type=click.Choice(FORMATS), default="ndjson", show_default=True)
+    @table_option
+    @chunk_option
+    @jobs_option
+    def export_data_command(directory, file_format, tables, chunk_size, jobs):
+        """Write every table to DIRECTORY/<table>.ndjson or .csv."""
+        os.makedirs(directory, exist_ok=True)
+        started = time.monotonic()
+        results = export_tables(db.engine, list(tables or MODELS), directory, file_format, chunk_size, jobs)
+        report_total("exported", results, started)
+
+    @app.cli.command("import-data")
+    @click.argument("directory", type=click.Path(exists=True, file_okay=False))
+    @table_option
+    @chunk_option
+    @jobs_option
+    def import_data_command(directory, tables, chunk_size, jobs):
+        """Load DIRECTORY/<table>.ndjson or .csv files into empty tables."""
+        paths = {}
+        for table in tables or MODELS:
+            found = [os.path.join(directory, table + "." + extension) for extension in FORMATS
+                     if os.path.exists(os.path.join(directory, table + "." + extension))]
+            if len(found) > 1:
+                raise click.ClickException("both " + " and ".join(found) + " exist, keep only one")
+            if found:
+                paths[table] = found[0]
+            elif tables:
+                raise click.ClickException("no " + table + ".ndjson or " + table + ".csv in " + directory)
+        if db.engine.dialect.name == "sqlite":
+            # sqlite solo admite un escritor a la vez
+            jobs = 1
+        started, results = time.monotonic(), []
+        for group in levels(list(paths)):
+            results += run_parallel(jobs, group, lambda table: import_table(app, table, paths[table], chunk_size))
+        rebuild_counts()
+        report_total("imported", results, started)
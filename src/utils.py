@@ -1,4 +1,10 @@
-from flask import jsonify, url_for
+import os
+import re
+import threading
+from flask import jsonify
+
+# <variable> o <converter:variable> / <converter(args):variable>, la sintaxis de las reglas de werkzeug
+RULE_VARIABLE = re.compile(r"<(?:(?P<converter>\w+)(?:\([^)]*\))?:)?(?P<variable>\w+)>")
 
 class APIException(Exception):
     status_code = 400
@@ -15,20 +21,89 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def web_threads():
+    """Threads per gunicorn worker: the --threads of GUNICORN_CMD_ARGS, 1 for sync workers."""
+    match = re.search(r"--threads[= ](\d+)", os.environ.get('GUNICORN_CMD_ARGS', ''))
+    return int(match.group(1)) if match else 1
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+class LazyMount:
+    """
+    WSGI middleware that sends the requests under `prefix` to a second app, built by
+    `factory` on the first of them, and everything else to `wsgi_app`.
+    """
+    def __init__(self, wsgi_app, prefix, factory):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+        self.factory = factory
+        self.mounted = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path != self.prefix and not path.startswith(self.prefix + "/"):
+            return self.wsgi_app(environ, start_response)
+        if self.mounted is None:
+            with self.lock:
+                if self.mounted is None:
+                    self.mounted = self.factory()
+        return self.mounted(environ, start_response)
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
+def build_route_catalog(app):
+    """Every route of the app: path, methods, path parameters and the view's docstring."""
+    adapter = app.url_map.bind("localhost")
+    catalog = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: (rule.rule, rule.endpoint)):
+        if rule.endpoint == "static":
+            continue
+        view = app.view_functions.get(rule.endpoint)
+        doc = (view.__doc__ or "").strip().splitlines() if view is not None else []
+        catalog.append({
+            "endpoint": rule.endpoint,
+            "path": rule.rule,
+            "methods": sorted(rule.methods - {"HEAD", "OPTIONS"}),
+            "parameters": [{"name": match.group("variable"), "type": match.group("converter") or "default"}
+                           for match in RULE_VARIABLE.finditer(rule.rule)],
+            "description": doc[0] if doc else None,
+            # solo las rutas GET sin parametros se listan en el sitemap
+            "link": adapter.build(rule.endpoint, rule.defaults or {}) if "GET" in rule.methods and has_no_empty_params(rule) else None,
+        })
+    return catalog
+
+def route_catalog(app):
+    """
+    The route catalog, built once and kept in app.extensions; it is rebuilt only if
+    routes were added since (the number of view functions changed).
+    """
+    key = len(app.view_functions)
+    cached = app.extensions.get("route_catalog")
+    if cached is None or cached[0] != key:
+        catalog = build_route_catalog(app)
+        cached = (key, catalog, render_sitemap(app, catalog))
+        app.extensions["route_catalog"] = cached
+    return cached[1]
+
 def generate_sitemap(app):
-    links = ['/admin/']
-    for rule in app.url_map.iter_rules():
+    route_catalog(app)
+    return app.extensions["route_catalog"][2]
+
+def render_sitemap(app, catalog):
+    links = ['/admin/'] if app.config.get('FEATURE_ADMIN', True) else []
+    for route in catalog:
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
-        if "GET" in rule.methods and has_no_empty_params(rule):
-            url = url_for(rule.endpoint, **(rule.defaults or {}))
-            if "/admin/" not in url:
-                links.append(url)
+        if route["link"] is not None and "/admin/" not in route["link"]:
+            links.append(route["link"])
 
     links_html = "".join(["<li><a href='" + y + "'>" + y + "</a></li>" for y in links])
     return """
@@ -0,0 +1,293 @@
+"""
+Optional write-behind mode for the favorite toggles (FAVORITES_WRITE_BEHIND=true).
+
+The POST/DELETE /user/<id>/favorite/<kind>/<id> handlers append the operation to a
+local SQLite queue in WAL mode (FAVORITES_QUEUE_PATH) and answer 202 right away.
+A background thread flushes the queue to the main database in batches of up to
+FAVORITES_FLUSH_BATCH operations, one transaction per batch:
+
+- Operations on the same (user, item) are coalesced and the last one wins, so an
+  add followed by a remove costs one idempotent DELETE instead of two commits.
+  Adds become one bulk INSERT per kind and removes one DELETE per kind, and the
+  popularity counters are adjusted only by the rows that really changed.
+- Applying a batch is idempotent and the queue rows are only deleted after the main
+  database commits, so a crash in between just replays the batch.
+- Only one process per host flushes (a lock file next to the queue), so batches
+  are applied in order. Operations pointing to users or items that no longer exist
+  are dropped and logged on the `write_behind` logger.
+
+GET /user/<id>/favorites, /user/<id>/dashboard and /user/<id>?include=favorites
+overlay the still queued operations of that user, so clients read their own writes;
+their cache keys include the last queued sequence number (queue_marker), so every
+worker of the host stops serving cached responses from before the write. The user
+collection (GET /user?include=favorites) only shows them once flushed. The queue is
+per host: with several hosts, toggles of the same favorite sent to different hosts
+are applied in flush order.
+
+    $ pipenv run flask flush-favorites    # drain the queue now
+"""
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+import click
+from models import db, User, Favorite
+from utils import env_flag
+from cache import bump_versions, mark_changed
+from collection import fetch_by_ids
+from popularity import KINDS, adjust_counts
+
+logger = logging.getLogger("write_behind")
+
+class FavoriteQueue:
+    """
+    Append-only queue of favorite operations in a SQLite file, one connection per
+    thread, opened on first use so a gunicorn --preload master never hands one to
+    the forked workers.
+    """
+    def __init__(self, path, synchronous="FULL"):
+        self.path = path
+        self.synchronous = synchronous
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # autocommit: cada INSERT es su propia transaccion, escrita a disco antes de responder
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=" + self.synchronous)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS favorite_queue (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_id INTEGER NOT NULL, kind TEXT NOT NULL, target_id INTEGER NOT NULL, operation TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_favorite_queue_user_id ON favorite_queue (user_id)")
+            self.local.connection = connection
+        return connection
+
+    def append(self, user_id, kind, target_id, operation):
+        self.connection().execute("INSERT INTO favorite_queue (user_id, kind, target_id, operation) VALUES (?, ?, ?, ?)",
+                                  (user_id, kind, target_id, operation))
+
+    def pending(self, user_id):
+        """{(kind, target_id): operation} still queued for the user, last operation wins."""
+        rows = self.connection().execute("SELECT kind, target_id, operation FROM favorite_queue WHERE user_id = ? "
+                                         "ORDER BY seq", (user_id,))
+        return {(kind, target_id): operation for kind, target_id, operation in rows}
+
+    def batch(self, size):
+        return self.connection().execute("SELECT seq, user_id, kind, target_id, operation FROM favorite_queue "
+                                         "ORDER BY seq LIMIT ?", (size,)).fetchall()
+
+    def discard(self, last_seq):
+        self.connection().execute("DELETE FROM favorite_queue WHERE seq <= ?", (last_seq,))
+
+    def depth(self):
+        return self.connection().execute("SELECT COUNT(*) FROM favorite_queue").fetchone()[0]
+
+    def last_seq(self):
+        """Sequence number of the last operation ever queued (AUTOINCREMENT never reuses one)."""
+        row = self.connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'favorite_queue'").fetchone()
+        return row[0] if row else 0
+
+queue = None
+flusher = None
+flusher_lock = threading.Lock()
+
+def enabled():
+    return queue is not None
+
+def enqueue_favorite(user_id, operation, **target):
+    """Queues an "add" or "remove" of the favorite, e.g. enqueue_favorite(1, "add", planet_id=3)."""
+    column, target_id = list(target.items())[0]
+    kind = column.replace("_id", "")
+    queue.append(user_id, kind, target_id, operation)
+    # invalida las respuestas cacheadas de favoritos como lo haria el commit
+    bump_versions(["favorite"])
+    return {"queued": True, kind: {"user_id": user_id, column: target_id}}
+
+def queue_marker():
+    """
+    Extra cache key for the routes that overlay the queue: changes with every operation
+    queued on this host, whichever worker queued it.
+    """
+    return str(queue.last_seq()) if enabled() else ""
+
+def pending_items(pending, kind):
+    """{id: serialized item} of the queued adds of `kind`, in one IN query."""
+    column, model = KINDS[kind]
+    return fetch_by_ids(model, [target_id for (name, target_id), operation in pending.items()
+                                if name == kind and operation == "add"])
+
+def overlay_favorites(user_id, favorites, include=None):
+    """
+    Applies the user's queued operations to a serialized list of favorites. `include`
+    is the ?include= tree they were serialized with, so queued adds get the same
+    nested character/planet/vehicle.
+    """
+    if not enabled():
+        return favorites
+    pending = queue.pending(user_id)
+    if not pending:
+        return favorites
+    result = []
+    for favorite in favorites:
+        key = next(((kind, favorite[column]) for kind, (column, model) in KINDS.items() if favorite.get(column) is not None), None)
+        operation = pending.pop(key, None)
+        if operation != "remove":
+            result.append(favorite)
+    items = {kind: pending_items(pending, kind) for kind in KINDS if kind in (include or {})}
+    for (kind, target_id), operation in pending.items():
+        if operation == "add":
+            favorite = {"id": None, "user_id": user_id, "pending": True}
+            favorite.update({column: target_id if name == kind else None for name, (column, model) in KINDS.items()})
+            for name in include or {}:
+                favorite[name] = items[name].get(target_id) if name == kind else None
+            result.append(favorite)
+    return result
+
+def overlay_dashboard(user_id, dashboard):
+    """Applies the user's queued operations to a user_dashboard page; adds go on the last page."""
+    if not enabled():
+        return dashboard
+    pending = queue.pending(user_id)
+    if not pending:
+        return dashboard
+    for kind, (column, model) in KINDS.items():
+        group = kind + "s"
+        entries = [entry for entry in dashboard["favorites"][group] if pending.get((kind, entry["id"])) != "remove"]
+        if dashboard["next"] is None:
+            items = pending_items(pending, kind)
+            # un add de algo que ya era favorito (en otra pagina) no se repite
+            target = getattr(Favorite, column)
+            existing = set(value for (value,) in db.session.query(target)
+                           .filter(Favorite.user_id == user_id, target.in_(list(items)))) if items else set()
+            entries += [dict(item, favorite_id=None, pending=True) for target_id, item in items.items()
+                        if target_id not in existing]
+        dashboard["favorites"][group] = entries
+    return dashboard
+
+def apply_operations(operations):
+    """
+    Applies coalesced {(user_id, kind, target_id): operation} to the main database in
+    one transaction. Returns how many operations were dropped for missing rows.
+    """
+    user_ids = set(user_id for user_id, kind, target_id in operations)
+    users = set(value for (value,) in db.session.query(User.id).filter(User.id.in_(user_ids))) if user_ids else set()
+    dropped = 0
+    for kind, (column, model) in KINDS.items():
+        adds = set((user_id, target_id) for (user_id, name, target_id), operation in operations.items()
+                   if name == kind and operation == "add")
+        removes = set((user_id, target_id) for (user_id, name, target_id), operation in operations.items()
+                      if name == kind and operation == "remove")
+        pairs = adds | removes
+        if not pairs:
+            continue
+        target = getattr(Favorite, column)
+        existing = {}
+        query = db.session.query(Favorite.id, Favorite.user_id, target)
+        query = query.filter(Favorite.user_id.in_(set(user_id for user_id, target_id in pairs)))
+        for favorite_id, user_id, target_id in query.filter(target.in_(set(target_id for user_id, target_id in pairs))):
+            existing[(user_id, target_id)] = favorite_id
+
+        if adds:
+            targets = set(value for (value,) in db.session.query(model.id).filter(model.id.in_(set(target_id for user_id, target_id in adds))))
+            rows = [{"user_id": user_id, column: target_id} for user_id, target_id in adds
+                    if (user_id, target_id) not in existing and user_id in users and target_id in targets]
+            dropped += len([pair for pair in adds if pair[0] not in users or pair[1] not in targets])
+            if rows:
+                db.session.bulk_insert_mappings(Favorite, rows)
+                adjust_counts(rows, 1)
+        deleted = [(pair, existing[pair]) for pair in removes if pair in existing]
+        if deleted:
+            adjust_counts([{column: target_id} for (user_id, target_id), favorite_id in deleted], -1)
+            Favorite.query.filter(Favorite.id.in_([favorite_id for pair, favorite_id in deleted])).delete(synchronize_session=False)
+    mark_changed(db.session, "favorite")
+    db.session.commit()
+    return dropped
+
+def flush_once(app, size):
+    """Flushes one batch; returns how many queued operations it consumed."""
+    rows = queue.batch(size)
+    if not rows:
+        return 0
+    operations = {}
+    for seq, user_id, kind, target_id, operation in rows:
+        operations[(user_id, kind, target_id)] = operation
+    with app.app_context():
+        try:
+            dropped = apply_operations(operations)
+        except Exception:
+            db.session.rollback()
+            raise
+    if dropped:
+        logger.warning("dropped %d favorite operations for users or items that do not exist", dropped)
+    queue.discard(rows[-1][0])
+    return len(rows)
+
+class Flusher(threading.Thread):
+    def __init__(self, app, size, interval):
+        super().__init__(name="favorite-flusher", daemon=True)
+        self.app = app
+        self.size = size
+        self.interval = interval
+
+    def run(self):
+        lock_file = open(queue.path + ".lock", "a")
+        while True:
+            try:
+                # solo un proceso por maquina vacia la cola, para aplicar los lotes en orden
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(self.interval * 10)
+        while True:
+            try:
+                flushed = flush_once(self.app, self.size)
+            except Exception:
+                logger.exception("could not flush the favorite queue, retrying")
+                flushed = 0
+                time.sleep(self.interval * 10)
+            if flushed < self.size:
+                time.sleep(self.interval)
+
+def setup_write_behind(app):
+    global queue
+    size = int(os.environ.get('FAVORITES_FLUSH_BATCH', 500))
+
+    @app.cli.command("flush-favorites")
+    def flush_favorites_command():
+        """Apply every queued favorite operation to the database."""
+        if queue is None:
+            raise click.ClickException("write-behind is off, set FAVORITES_WRITE_BEHIND=true")
+        lock_file = open(queue.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise click.ClickException("a running server is already flushing " + queue.path)
+        total = 0
+        while True:
+            flushed = flush_once(app, size)
+            total += flushed
+            if not flushed:
+                break
+        click.echo(str(total) + " queued favorite operations flushed")
+
+    if not env_flag('FAVORITES_WRITE_BEHIND', False):
+        queue = None
+        return
+    path = os.environ.get('FAVORITES_QUEUE_PATH') or os.path.join(app.instance_path, "favorites-queue.db")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    queue = FavoriteQueue(path, synchronous=os.environ.get('FAVORITES_QUEUE_SYNC', 'FULL'))
+    interval = float(os.environ.get('FAVORITES_FLUSH_INTERVAL', 0.2))
+
+    def start_flusher():
+        # el hilo se arranca con la primera peticion de cada proceso, despues del fork de gunicorn
+        global flusher
+        if flusher is None:
+            with flusher_lock:
+                if flusher is None:
+                    flusher = Flusher(app, size, interval)
+                    flusher.start()
+    app.before_request(start_flusher)
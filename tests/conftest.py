@@ -0,0 +1,83 @@
+"""
+Fixtures shared by the tests: a fresh app per test, built with create_app on its own
+SQLite file with the tables created from the models, its test client and a few
+seeded rows.
+
+    $ pipenv install --dev
+    $ pipenv run test
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import pytest
+from flask.testing import FlaskClient
+from main import create_app
+from models import db, User, Character, Planet, Vehicle, Favorite
+
+# variables de entorno que cambian el comportamiento de la app: cada test parte sin ellas
+SETTINGS = ("CACHE_BACKEND", "CACHE_TTL", "RATE_LIMIT_RATE", "RATE_LIMIT_BACKEND", "EXPENSIVE_MAX_CONCURRENT",
+            "RATE_LIMIT_TRUST_PROXY", "RATE_LIMIT_API_KEYS", "GUNICORN_CMD_ARGS",
+            "FAVORITES_WRITE_BEHIND", "SNAPSHOT_TABLES", "DB_REPLICA_CONNECTION_STRINGS", "FLASK_RUN_FROM_CLI")
+
+class BufferedClient(FlaskClient):
+    """
+    Reads and closes every response, like a WSGI server does; without it a stream
+    keeps its @limit_concurrency slot until it is garbage collected. Tests that
+    hold a stream open pass buffered=False.
+    """
+    def open(self, *args, **kwargs):
+        kwargs.setdefault("buffered", True)
+        return super().open(*args, **kwargs)
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """make_app(CACHE_TTL="0", ...) builds the app with those environment variables."""
+    def make_app(**environment):
+        for name in SETTINGS:
+            monkeypatch.delenv(name, raising=False)
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.db"),
+                          "TESTING": True, "FEATURE_ADMIN": False})
+        app.test_client_class = BufferedClient
+        with app.app_context():
+            db.create_all()
+        return app
+    return make_app
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def seed(users=3, items=3):
+    """
+    Adds `items` characters, planets and vehicles and `users` users, each new user with
+    every item as favorite. Can be called again to grow the tables.
+    """
+    start = Character.query.count()
+    for index in range(start, start + items):
+        db.session.add(Character(name="character %d" % index, age=index, gender="n/a", skin_color="grey"))
+        db.session.add(Planet(name="planet %d" % index, gravity=1, population=index, climate="arid", terrain="desert"))
+        db.session.add(Vehicle(name="vehicle %d" % index, model="model", capacity=index, vehicle_class="wheeled"))
+    start = User.query.count()
+    new_users = [User(name="user %d" % index, username="user%d" % index, email="user%d@example.com" % index)
+                 for index in range(start, start + users)]
+    db.session.add_all(new_users)
+    db.session.flush()
+    for user in new_users:
+        for model, column in ((Character, "character_id"), (Planet, "planet_id"), (Vehicle, "vehicle_id")):
+            for item in model.query:
+                db.session.add(Favorite(user_id=user.id, **{column: item.id}))
+    db.session.commit()
+
+@pytest.fixture
+def seeded(app):
+    with app.app_context():
+        seed()
+    return app
@@ -0,0 +1,60 @@
+"""
+Dict-backed stand-ins for the services the app can talk to, so the shared backends
+run in the tests without a server.
+"""
+import math
+import time
+
+class FakeRedis:
+    """
+    The redis-py commands used by cache.RedisCache and ratelimit.RedisBuckets, with
+    values stored as bytes like redis returns them and expiry measured on `clock`.
+    `eval` only knows ratelimit.TAKE_SCRIPT and runs the same steps in python; the
+    Lua itself is tested against fakeredis when it is installed.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+
+    def alive(self, key):
+        if key in self.expires and self.expires[key] <= self.clock():
+            del self.expires[key]
+            self.data.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self.alive(key) else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        if ex is not None:
+            self.expires[key] = self.clock() + ex
+        else:
+            self.expires.pop(key, None)
+
+    def incr(self, key):
+        value = int(self.get(key) or 0) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def dbsize(self):
+        return len([key for key in list(self.data) if self.alive(key)])
+
+    def eval(self, script, numkeys, key, rate, burst, now):
+        rate, burst, now = float(rate), float(burst), float(now)
+        bucket = self.data.get(key) if self.alive(key) else None
+        tokens = float(bucket["tokens"]) if bucket else burst
+        updated = float(bucket["updated"]) if bucket else now
+        tokens = min(burst, tokens + max(0, now - updated) * rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self.data[key] = {"tokens": tokens, "updated": now}
+        self.expires[key] = self.clock() + math.ceil(burst / rate) + 1
+        return str(wait).encode()
@@ -0,0 +1,27 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+
+@contextmanager
+def count_queries(engine):
+    """
+    Collects every SQL statement sent through `engine` while the block runs:
+
+        with count_queries(db.engine) as statements:
+            client.get('/user?include=favorites')
+        assert len(statements) == 2
+    """
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+@contextmanager
+def assert_num_queries(engine, expected):
+    with count_queries(engine) as statements:
+        yield statements
+    if len(statements) != expected:
+        raise AssertionError("Expected " + str(expected) + " queries, got " + str(len(statements)) + ":\n" + "\n".join(statements))
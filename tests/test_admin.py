@@ -0,0 +1,14 @@
+import pytest
+from main import create_admin_app
+from models import db
+
+def test_admin_shares_the_api_engine(seeded):
+    pytest.importorskip("flask_admin")
+    admin_app = create_admin_app(seeded)
+    with seeded.app_context():
+        engine = db.engine
+    response = admin_app.test_client().get("/admin/character/")
+    assert response.status_code == 200
+    assert b"character 1" in response.data
+    with admin_app.app_context():
+        assert db.engine is engine
@@ -0,0 +1,119 @@
+import time
+import pytest
+from sqlalchemy import text
+import cache
+from cache import LRUCache, RedisCache
+from models import db
+from tests.conftest import seed
+from tests.fakes import FakeRedis
+
+def update_outside_the_orm(app):
+    # como otro worker o un UPDATE a mano: ningun evento de sesion de este proceso lo ve
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(text("UPDATE character SET name = 'renamed' WHERE id = 1"))
+
+def test_matching_etag_is_answered_with_304(seeded, client):
+    etag = client.get("/character/1").headers["ETag"]
+    response = client.get("/character/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+def test_commit_changes_the_etag(seeded, client):
+    etag = client.get("/character/1").headers["ETag"]
+    assert client.delete("/character/2").status_code == 200
+    assert client.get("/character/1", headers={"If-None-Match": etag}).status_code == 200
+
+def test_memory_backend_etag_expires_with_the_cache_ttl(make_app, monkeypatch):
+    app = make_app(CACHE_TTL="60")
+    with app.app_context():
+        seed()
+    client = app.test_client()
+    now = [time.monotonic()]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    etag = client.get("/character/1").headers["ETag"]
+    update_outside_the_orm(app)
+    now[0] += 61
+    response = client.get("/character/1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()["response"]["name"] == "renamed"
+    assert response.headers["ETag"] != etag
+
+def test_memory_backend_without_ttl_sends_no_validators(make_app):
+    app = make_app(CACHE_TTL="0")
+    with app.app_context():
+        seed()
+    client = app.test_client()
+    response = client.get("/character/1")
+    assert "ETag" not in response.headers
+    update_outside_the_orm(app)
+    response = client.get("/character/1", headers={"If-None-Match": "*"})
+    assert response.status_code == 200
+    assert response.get_json()["response"]["name"] == "renamed"
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_lru_evicts_the_least_recently_used_entry():
+    backend = LRUCache(max_entries=2)
+    backend.set("a", b"1")
+    backend.set("b", b"2")
+    assert backend.get("a") == b"1"
+    backend.set("c", b"3")
+    assert backend.get("b") is None
+    assert (backend.get("a"), backend.get("c"), backend.size()) == (b"1", b"3", 2)
+
+def test_lru_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    backend = LRUCache(ttl=60)
+    backend.set("a", b"1")
+    clock.now += 60
+    assert backend.get("a") == b"1"
+    clock.now += 1
+    assert backend.get("a") is None
+    assert backend.size() == 0
+
+def test_redis_entries_expire_after_the_ttl():
+    clock = Clock()
+    backend = RedisCache(FakeRedis(clock), ttl=60)
+    backend.set("a", b"1")
+    assert backend.get("a") == b"1"
+    clock.now += 60
+    assert backend.get("a") is None
+
+def test_redis_versions_are_shared_between_workers():
+    client = FakeRedis()
+    first, second = RedisCache(client), RedisCache(client)
+    assert second.get_counters(["planet"]) == [0]
+    first.incr("planet")
+    first.set_modified("planet", 1234.5)
+    assert second.get_counters(["planet", "user"]) == [1, 0]
+    assert second.get_modified(["planet", "user"]) == [1234.5, None]
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_commit_invalidates_cached_responses(seeded, monkeypatch, backend):
+    if backend == "redis":
+        monkeypatch.setattr(cache, "backend", RedisCache(FakeRedis()))
+    client = seeded.test_client()
+    assert client.get("/character").headers["X-Cache"] == "MISS"
+    assert client.get("/character").headers["X-Cache"] == "HIT"
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    response = client.get("/character")
+    assert response.headers["X-Cache"] == "MISS"
+    assert len(response.get_json()["response"]) == 4
+    # una tabla que la ruta no lee no invalida nada
+    client.post("/user", json={"name": "new", "username": "new", "email": "new@example.com"})
+    assert client.get("/character").headers["X-Cache"] == "HIT"
+
+def test_shared_backend_sends_last_modified(seeded, monkeypatch):
+    monkeypatch.setattr(cache, "backend", RedisCache(FakeRedis()))
+    client = seeded.test_client()
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    response = client.get("/character/1")
+    assert response.last_modified is not None
+    headers = {"If-Modified-Since": response.headers["Last-Modified"]}
+    assert client.get("/character/1", headers=headers).status_code == 304
@@ -0,0 +1,28 @@
+import gzip
+import pytest
+from cache import mark_changed
+from models import db, Planet
+
+@pytest.fixture
+def planets(make_app):
+    app = make_app(CACHE_TTL="0")
+    with app.app_context():
+        db.session.bulk_insert_mappings(Planet, [{"name": "planet %d" % index, "gravity": index % 3, "population": index,
+                                                  "climate": "arid", "terrain": "desert"} for index in range(5000)])
+        mark_changed(db.session, "planet")
+        db.session.commit()
+    return app
+
+def test_streamed_rows_are_not_flushed_one_by_one(planets):
+    client = planets.test_client()
+    plain = client.get("/planet", headers={"Accept": "application/x-ndjson"}).get_data()
+    response = client.get("/planet", headers={"Accept": "application/x-ndjson", "Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    streamed = response.get_data()
+    assert gzip.decompress(streamed) == plain
+    # con un flush por fila salia mas del doble que el cuerpo comprimido de una vez
+    assert len(streamed) < len(gzip.compress(plain)) * 1.2
+
+def test_small_bodies_are_sent_as_they_are(planets):
+    response = planets.test_client().get("/planet/1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
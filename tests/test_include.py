@@ -0,0 +1,42 @@
+import pytest
+from models import db
+from tests.conftest import seed
+from tests.helpers import assert_num_queries
+
+@pytest.mark.parametrize("include, expected", [
+    ("favorites", 2),
+    ("favorites,favorites.character", 3),
+    ("favorites,favorites.character,favorites.planet,favorites.vehicle", 5),
+])
+def test_user_list_include_uses_one_query_per_relationship(app, client, include, expected):
+    with app.app_context():
+        seed(users=10)
+        with assert_num_queries(db.engine, expected):
+            response = client.get("/user?include=" + include)
+    assert response.status_code == 200
+    users = response.get_json()["response"]
+    assert len(users) == 10
+    assert all(len(user["favorites"]) == 9 for user in users)
+
+def test_user_list_query_count_does_not_grow_with_the_page(app, client):
+    with app.app_context():
+        seed(users=2)
+        with assert_num_queries(db.engine, 3):
+            client.get("/user?include=favorites,favorites.character")
+        seed(users=30, items=0)
+        with assert_num_queries(db.engine, 3):
+            response = client.get("/user?include=favorites,favorites.character")
+    assert len(response.get_json()["response"]) == 32
+
+def test_one_user_include_is_a_single_query(seeded, client):
+    with seeded.app_context():
+        with assert_num_queries(db.engine, 1):
+            response = client.get("/user/1?include=favorites,favorites.character,favorites.planet")
+    user = response.get_json()["response"]
+    assert len(user["favorites"]) == 9
+    assert sorted(favorite["character"]["name"] for favorite in user["favorites"] if favorite["character"]) == \
+        ["character 0", "character 1", "character 2"]
+
+def test_unknown_include_is_rejected(seeded, client):
+    response = client.get("/user?include=password")
+    assert response.status_code == 400
@@ -0,0 +1,10 @@
+import os
+import re
+
+def test_every_sample_is_labelled_with_the_worker_pid(seeded, client):
+    client.get("/character/1")
+    body = client.get("/metrics").get_data(as_text=True)
+    samples = [line for line in body.splitlines() if not line.startswith("#")]
+    assert any(line.startswith("swapi_request_duration_seconds_count{") for line in samples)
+    # sin la etiqueta, cada scrape a otro worker parece un reinicio del contador
+    assert all(re.match(r'\w+\{pid="' + str(os.getpid()) + '"[,}]', line) for line in samples)
@@ -0,0 +1,51 @@
+import pytest
+from models import db, Character, Favorite
+from popularity import inconsistent_counts
+from tests.conftest import seed
+
+@pytest.fixture
+def client(seeded):
+    return seeded.test_client()
+
+def assert_consistent(app):
+    with app.app_context():
+        assert inconsistent_counts() == {}
+
+def test_seeded_favorites_are_counted(seeded):
+    assert_consistent(seeded)
+    with seeded.app_context():
+        assert db.session.query(Character.favorite_count).filter_by(id=1).scalar() == 3
+
+def test_add_and_remove_favorite(seeded, client):
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    assert client.post("/user/1/favorite/character/4").get_json()["created"] is True
+    assert client.post("/user/1/favorite/character/4").get_json()["created"] is False
+    assert client.delete("/user/2/favorite/planet/1").status_code == 200
+    assert client.delete("/user/2/favorite/planet/1").status_code == 404
+    assert_consistent(seeded)
+
+def test_favorite_bulk_create_and_delete(seeded, client):
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    rows = [{"user_id": user_id, "character_id": 4} for user_id in (1, 2, 3)] + [{"user_id": 1, "planet_id": 1}]
+    assert client.post("/favorite/bulk", json=rows).get_json() == {"created": 3, "skipped": 1, "errors": []}
+    assert_consistent(seeded)
+    assert client.delete("/favorite/bulk", json={"ids": [1, 2, 3, 4, 5]}).get_json() == {"deleted": 5}
+    assert_consistent(seeded)
+
+@pytest.mark.parametrize("path", ["/user/1", "/character/1", "/planet/2", "/vehicle/3"])
+def test_deletes_with_dependent_favorites(seeded, client, path):
+    assert client.delete(path).status_code == 200
+    assert_consistent(seeded)
+
+def test_orm_writes_like_the_admin(seeded):
+    with seeded.app_context():
+        seed(users=0, items=1)
+        favorite = Favorite.query.filter_by(user_id=1, character_id=1).one()
+        favorite.character_id = 4
+        db.session.commit()
+        assert inconsistent_counts() == {}
+        db.session.delete(Favorite.query.filter_by(user_id=2, character_id=2).one())
+        db.session.add(Favorite(user_id=2, character_id=4))
+        db.session.commit()
+        assert inconsistent_counts() == {}
+        assert db.session.query(Character.favorite_count).filter_by(id=4).scalar() == 2
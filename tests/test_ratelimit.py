@@ -0,0 +1,97 @@
+import pytest
+from flask import Flask, Response
+import ratelimit
+from ratelimit import MemoryBuckets, RedisBuckets, limit_concurrency
+from tests.fakes import FakeRedis
+
+def lua_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return fakeredis.FakeRedis()
+
+@pytest.mark.parametrize("make_buckets", [MemoryBuckets, lambda: RedisBuckets(FakeRedis()),
+                                          lambda: RedisBuckets(lua_redis())], ids=["memory", "fake", "lua"])
+def test_token_bucket(make_buckets):
+    buckets = make_buckets()
+    # rafaga de 2 y un token por segundo
+    assert [buckets.take("client", 1, 2, 100.0) for _ in range(3)] == [0, 0, 1.0]
+    assert buckets.take("client", 1, 2, 100.5) == 0.5
+    assert buckets.take("client", 1, 2, 101.0) == 0
+    assert buckets.take("other", 1, 2, 101.0) == 0
+
+def test_lua_script_matches_the_memory_buckets():
+    memory, redis = MemoryBuckets(), RedisBuckets(lua_redis())
+    for now in (0, 0, 0, 0.3, 0.4, 2, 2, 2, 2, 2.1, 9):
+        assert redis.take("client", 2, 3, now) == pytest.approx(memory.take("client", 2, 3, now))
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_empty_bucket_answers_429_with_retry_after(seeded, monkeypatch, backend):
+    monkeypatch.setenv("RATE_LIMIT_RATE", "0.5")
+    monkeypatch.setenv("RATE_LIMIT_BURST", "2")
+    if backend == "redis":
+        monkeypatch.setattr(ratelimit, "buckets", RedisBuckets(FakeRedis()))
+    client = seeded.test_client()
+    assert [client.get("/planet/1").status_code for _ in range(2)] == [200, 200]
+    response = client.get("/planet/1")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    # la salud y las metricas no se limitan
+    assert client.get("/health/db").status_code == 200
+
+def statuses(client, requests):
+    return [client.get("/planet/1", **request).status_code for request in requests]
+
+def test_clients_cannot_get_new_buckets_by_spoofing_headers(seeded, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_RATE", "0.01")
+    monkeypatch.setenv("RATE_LIMIT_BURST", "1")
+    monkeypatch.setenv("RATE_LIMIT_TRUST_PROXY", "true")
+    monkeypatch.setenv("RATE_LIMIT_API_KEYS", "partner")
+    client = seeded.test_client()
+    # el router de Heroku agrega la IP real al final del X-Forwarded-For
+    spoofed = [{"headers": {"X-Forwarded-For": "10.0.0.%d, 1.2.3.4" % hop}} for hop in range(3)]
+    assert statuses(client, spoofed) == [200, 429, 429]
+    assert statuses(client, [{"headers": {"X-Forwarded-For": "5.6.7.8"}}]) == [200]
+    made_up = [{"headers": {"X-Forwarded-For": "9.9.9.9", "X-API-Key": "key %d" % key}} for key in range(3)]
+    assert statuses(client, made_up) == [200, 429, 429]
+    # solo una clave de RATE_LIMIT_API_KEYS tiene su propio cubo
+    assert statuses(client, [{"headers": {"X-Forwarded-For": "9.9.9.9", "X-API-Key": "partner"}}] * 2) == [200, 429]
+
+def test_default_cap_sheds_below_the_worker_threads(monkeypatch):
+    monkeypatch.delenv("EXPENSIVE_MAX_CONCURRENT", raising=False)
+    monkeypatch.delenv("GUNICORN_CMD_ARGS", raising=False)
+    assert ratelimit.default_max_concurrent() == 1
+    monkeypatch.setenv("GUNICORN_CMD_ARGS", "--threads 4 --timeout 30")
+    assert ratelimit.default_max_concurrent() == 3
+    monkeypatch.setenv("EXPENSIVE_MAX_CONCURRENT", "8")
+    assert ratelimit.default_max_concurrent() == 8
+
+def test_app_sheds_with_the_default_settings(seeded):
+    client = seeded.test_client()
+    ndjson = {"Accept": "application/x-ndjson"}
+    streaming = client.get("/planet", headers=ndjson, buffered=False)
+    # una respuesta en curso ya ocupa el unico hilo que el cap deja a /planet
+    shed = client.get("/planet", headers=ndjson)
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == "1"
+    assert client.get("/vehicle", headers=ndjson).status_code == 200
+    b"".join(streaming.response)
+    streaming.close()
+    assert client.get("/planet", headers=ndjson).status_code == 200
+
+def test_concurrency_cap_sheds_with_503_until_the_stream_closes():
+    app = Flask(__name__)
+
+    @app.route("/expensive")
+    @limit_concurrency(1)
+    def expensive():
+        return Response(iter(["row\n"] * 3), mimetype="application/x-ndjson")
+
+    client = app.test_client()
+    streaming = client.get("/expensive", buffered=False)
+    shed = client.get("/expensive")
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == "1"
+    assert ratelimit.get_stats()["shed"]["expensive"] >= 1
+    assert b"".join(streaming.response) == b"row\n" * 3
+    streaming.close()
+    assert client.get("/expensive").status_code == 200
@@ -0,0 +1,62 @@
+import shutil
+import time
+import pytest
+from sqlalchemy import create_engine
+import cache
+from cache import RedisCache
+import search
+from replicas import router
+from tests.conftest import seed
+from tests.fakes import FakeRedis
+
+def test_one_request_reads_from_a_single_replica(make_app, tmp_path, monkeypatch):
+    primary, replica, lagging = (str(tmp_path / name) for name in ("test.db", "r1.db", "r2.db"))
+    app = make_app()
+    with app.app_context():
+        seed()
+    shutil.copy(primary, replica)
+    shutil.copy(primary, lagging)
+    # la segunda replica todavia no recibio los favoritos
+    create_engine("sqlite:///" + lagging).execute("DELETE FROM favorite")
+
+    monkeypatch.setattr(router, "replicas", [])
+    app = make_app(CACHE_TTL="0", DB_REPLICA_CONNECTION_STRINGS="sqlite:///" + replica + ",sqlite:///" + lagging)
+    client = app.test_client()
+    counts = set()
+    for _ in range(4):
+        users = client.get("/user?include=favorites").get_json()["response"]
+        counts.add(tuple(len(user["favorites"]) for user in users))
+    # cada peticion ve una replica entera: o todos los favoritos o ninguno, y las dos se usan
+    assert counts == {(9, 9, 9), (0, 0, 0)}
+
+@pytest.fixture
+def lagging_replica(make_app, tmp_path, monkeypatch):
+    primary, replica = str(tmp_path / "test.db"), str(tmp_path / "replica.db")
+    app = make_app()
+    with app.app_context():
+        seed()
+    shutil.copy(primary, replica)
+    monkeypatch.setattr(router, "replicas", [])
+    monkeypatch.setattr(cache, "backend", RedisCache(FakeRedis()))
+    app = make_app(DB_REPLICA_CONNECTION_STRINGS="sqlite:///" + replica, DB_REPLICA_LAG_WINDOW="5")
+    return app, replica
+
+def test_reads_after_a_write_skip_the_lagging_replica(lagging_replica, monkeypatch):
+    app, replica = lagging_replica
+    client = app.test_client()
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    # la replica aun no tiene el personaje nuevo: dentro de la ventana se lee del primario
+    response = client.get("/character")
+    assert len(response.get_json()["response"]) == 4
+    assert client.get("/character", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+def test_replica_serves_the_reads_after_the_lag_window(lagging_replica, monkeypatch):
+    app, replica = lagging_replica
+    client = app.test_client()
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 6)
+    assert len(client.get("/character").get_json()["response"]) == 3
+    # el indice de busqueda se recarga del primario aunque la peticion lea de la replica
+    monkeypatch.setattr(search, "indexes", {})
+    assert len(client.get("/search?q=new&kind=character").get_json()["response"]) == 1
@@ -0,0 +1,9 @@
+from utils import build_route_catalog
+
+def test_route_catalog_lists_the_path_parameters(app):
+    app.add_url_rule("/codes/<string(length=2):code>/<name>", "codes", lambda code, name: "")
+    routes = {route["endpoint"]: route for route in build_route_catalog(app)}
+    assert routes["api.favorite_planet"]["parameters"] == [{"name": "user_id", "type": "int"},
+                                                           {"name": "pl_id", "type": "int"}]
+    assert routes["codes"]["parameters"] == [{"name": "code", "type": "string"}, {"name": "name", "type": "default"}]
+    assert routes["api.get_all_planets"]["link"] == "/planet"
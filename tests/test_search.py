@@ -0,0 +1,51 @@
+import time
+import pytest
+import search
+from models import db, Character
+
+@pytest.fixture
+def search_app(seeded, monkeypatch):
+    monkeypatch.setattr(search, "indexes", {})
+    return seeded
+
+def names(client, query):
+    return [row["name"] for row in client.get("/search?kind=character&q=" + query).get_json()["response"]]
+
+def test_orm_writes_are_patched_into_the_index(search_app, monkeypatch):
+    client = search_app.test_client()
+    assert names(client, "character") == ["character 0", "character 1", "character 2"]
+    loads = []
+    monkeypatch.setattr(search, "load_index", lambda kind: loads.append(kind))
+    client.post("/character", json={"name": "Zorro Rojo", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    client.delete("/character/2")
+    with search_app.app_context():
+        Character.query.get(1).name = "renamed"
+        db.session.commit()
+    assert names(client, "zor ro") == ["Zorro Rojo"]
+    assert names(client, "character") == ["character 2"]
+    assert names(client, "renamed") == ["renamed"]
+    # ni la primera busqueda despues de escribir ni un hilo recargan la tabla
+    assert loads == [] and search.refreshing == set()
+
+def test_other_changes_rebuild_in_the_background(search_app):
+    client = search_app.test_client()
+    assert names(client, "bulk") == []
+    client.post("/character/bulk", json=[{"name": "bulk one", "age": 1, "gender": "n/a", "skin_color": "grey"}])
+    # mientras se recarga responde el indice anterior, sin cachearlo con la version nueva
+    response = client.get("/search?kind=character&q=bulk")
+    assert "ETag" not in response.headers
+    deadline = time.monotonic() + 10
+    while search.refreshing and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert names(client, "bulk") == ["bulk one"]
+
+def test_short_words_skip_mysql_fulltext(search_app, monkeypatch):
+    client = search_app.test_client()
+    fulltext = []
+    monkeypatch.setattr(search, "fulltext_prefix", lambda model, query_words, limit: fulltext.append(query_words) or [])
+    with search_app.app_context():
+        monkeypatch.setattr(db.engine.dialect, "name", "mysql")
+    assert names(client, "character") == []
+    # FULLTEXT ignora las palabras de menos de 3 letras: "ch" sale del indice en memoria
+    assert names(client, "ch 1") == ["character 1"]
+    assert fulltext == [["character"]]
@@ -0,0 +1,24 @@
+import pytest
+import snapshot
+from tests.conftest import seed
+
+@pytest.fixture
+def snapshot_app(make_app, monkeypatch):
+    monkeypatch.setattr(snapshot, "snapshots", {})
+    app = make_app(SNAPSHOT_TABLES="true", CACHE_TTL="0")
+    with app.app_context():
+        seed()
+    return app
+
+def test_reads_and_deletes_go_through_the_snapshot(snapshot_app):
+    client = snapshot_app.test_client()
+    assert client.get("/character/2").get_json()["response"]["name"] == "character 1"
+    assert "character" in snapshot.snapshots
+    assert client.delete("/character/2").status_code == 200
+    assert client.get("/character/2").status_code == 404
+    assert [row["id"] for row in client.get("/character").get_json()["response"]] == [1, 3]
+
+def test_several_workers_need_the_shared_backend(make_app, monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "2")
+    with pytest.raises(RuntimeError):
+        make_app(SNAPSHOT_TABLES="true")
@@ -0,0 +1,46 @@
+import json
+import sqlite3
+import transfer
+from models import db
+
+def read_ids(path, column):
+    with open(path) as lines:
+        return [json.loads(line)[column] for line in lines]
+
+def test_export_is_one_snapshot_while_the_app_writes(seeded, tmp_path, monkeypatch):
+    with seeded.app_context():
+        database = db.engine.url.database
+        db.engine.execute("PRAGMA journal_mode=WAL")
+    report = transfer.Progress.report
+    written = []
+
+    def write_after_the_first_table(progress):
+        if not written:
+            # otro proceso agrega un usuario con su favorito despues de exportar user
+            writer = sqlite3.connect(database)
+            writer.execute("INSERT INTO user (id, name, username, email) VALUES (99, 'late', 'late', 'late@example.com')")
+            writer.execute("INSERT INTO favorite (user_id, character_id) VALUES (99, 1)")
+            writer.commit()
+            writer.close()
+            written.append(True)
+        return report(progress)
+    monkeypatch.setattr(transfer.Progress, "report", write_after_the_first_table)
+
+    result = seeded.test_cli_runner().invoke(args=["export-data", str(tmp_path / "backup"), "--jobs", "4"])
+    assert result.exit_code == 0, result.output
+    assert written
+    users = read_ids(str(tmp_path / "backup" / "user.ndjson"), "id")
+    assert 99 not in users
+    assert set(read_ids(str(tmp_path / "backup" / "favorite.ndjson"), "user_id")) <= set(users)
+
+def test_export_then_import_keeps_every_row(seeded, tmp_path):
+    runner = seeded.test_cli_runner()
+    assert runner.invoke(args=["export-data", str(tmp_path / "backup"), "--format", "csv"]).exit_code == 0
+    with seeded.app_context():
+        db.drop_all()
+        db.create_all()
+    result = runner.invoke(args=["import-data", str(tmp_path / "backup")])
+    assert result.exit_code == 0, result.output
+    client = seeded.test_client()
+    assert len(client.get("/user").get_json()["response"]) == 3
+    assert client.get("/planet/2").get_json()["response"]["name"] == "planet 1"
@@ -0,0 +1,46 @@
+import pytest
+import writebehind
+from tests.conftest import seed
+
+@pytest.fixture
+def queued_app(make_app, tmp_path, monkeypatch):
+    # sin hilo de fondo: la cola se vacia solo cuando el test llama a flush_once
+    monkeypatch.setattr(writebehind, "flusher", object())
+    app = make_app(FAVORITES_WRITE_BEHIND="true", FAVORITES_QUEUE_PATH=str(tmp_path / "queue.db"))
+    with app.app_context():
+        seed(users=1, items=2)
+    return app
+
+def character_ids(favorites):
+    return sorted(favorite["character_id"] for favorite in favorites if favorite["character_id"])
+
+def test_queued_toggles_are_read_back_on_every_user_route(queued_app):
+    client = queued_app.test_client()
+    client.post("/character", json={"name": "new", "age": 1, "gender": "n/a", "skin_color": "grey"})
+    assert client.delete("/user/1/favorite/character/1").status_code == 202
+    assert client.post("/user/1/favorite/character/3").status_code == 202
+
+    favorites = client.get("/user/1/favorites?include=character").get_json()["result"]
+    assert character_ids(favorites) == [2, 3]
+    assert [favorite["character"]["name"] for favorite in favorites if favorite.get("pending")] == ["new"]
+
+    user = client.get("/user/1?include=favorites,favorites.character").get_json()["response"]
+    assert character_ids(user["favorites"]) == [2, 3]
+
+    dashboard = client.get("/user/1/dashboard").get_json()["response"]
+    assert [item["id"] for item in dashboard["favorites"]["characters"]] == [2, 3]
+
+    assert writebehind.flush_once(queued_app, 100) == 2
+    dashboard = client.get("/user/1/dashboard").get_json()["response"]
+    assert [item["id"] for item in dashboard["favorites"]["characters"]] == [2, 3]
+    assert not any(item.get("pending") for item in dashboard["favorites"]["characters"])
+
+def test_operations_queued_by_another_worker_skip_the_cached_responses(queued_app):
+    client = queued_app.test_client()
+    first = client.get("/user/1/favorites")
+    assert character_ids(first.get_json()["result"]) == [1, 2]
+    # otro worker de la maquina: escribe en la misma cola sin tocar las versiones de este proceso
+    writebehind.queue.append(1, "character", 1, "remove")
+    second = client.get("/user/1/favorites", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert character_ids(second.get_json()["result"]) == [2]